@@ -1,125 +1,593 @@
 from dolfin import *
 import numpy as np
 import os
-from msh2xdmf import import_mesh_from_xdmf
 from pathlib import Path
-from scipy.sparse import csc_matrix # pip install scikit-sparse
-from scipy.sparse.linalg import spsolve
-import sksparse.cholmod
+from scipy.spatial import cKDTree
+import sksparse.cholmod # pip install scikit-sparse
 import scipy
+import scipy.sparse
 import meshio
+import trimesh
 import logging
+import time
+import traceback
+import multiprocessing as mp
+from tqdm import tqdm
+from stl_to_msh import mesh_surface, mesh_counts, watchdog, process_alive, KILL_GRACE, WATCHDOG_PERIOD
+from check_edges_number import read_stl_triangles, weld_triangles
 
-#https://github.com/floiseau/msh2xdmf
 
-def InherentStrain(input: Path, output_folder: Path, k: int = 1.0e8, z_clamping_tolerance: float = 0.1):
+# Inherent strain tensor used when no load case is given
+DEFAULT_INHERENT_STRAIN = np.diag([-1.0, -1.0, -0.5])
+
+
+def mark_bottom(mesh, z_clamping_tolerance: float):
     """
-    Function deforming a part using the inherent strain methods.
+    Mark with 1 the exterior facets of mesh with all their vertices under z_clamping_tolerance (the supports),
+    the other facets with 0. Vectorized replacement of a SubDomain, which calls Python for every facet.
+    """
+    tdim = mesh.topology().dim()
+    BoundaryMarker = MeshFunction("size_t", mesh, tdim - 1)
+    BoundaryMarker.set_all(0)
+
+    exterior = BoundaryMesh(mesh, "exterior").entity_map(tdim - 1).array()
+    mesh.init(tdim - 1, 0)
+    facet_vertices = mesh.topology()(tdim - 1, 0)().reshape(-1, tdim)
+    z = mesh.coordinates()[facet_vertices[exterior], 2]
+    BoundaryMarker.array()[exterior[z.max(axis=1) < z_clamping_tolerance]] = 1
+    return BoundaryMarker
+
+
+def set_cell_tensor(function, strain):
+    """
+    Set the DG0 tensor Function function to strain in every cell, without Python call per cell.
     Args:
-        input: pathlib.Path, where the input file is
-        output_folder: pathlib.Path, where to save the output files
-        k = 1.0e8 int, the support rigidity
-        z_clamping_tolerance=0.1 float, all vertices under this z will be considered as supports.
+        function: Function of a TensorFunctionSpace(mesh, 'DG', 0)
+        strain: (3, 3) tensor, or function of the z of the cell midpoints (n,) returning (n, 3, 3) tensors
+            (for layer-wise strain fields)
+    """
+    T = function.function_space()
+    mesh = T.mesh()
+    tdim = mesh.topology().dim()
+    # dof of each component of the tensor in each cell
+    dofs = np.column_stack([T.sub(i).dofmap().entity_dofs(mesh, tdim) for i in range(T.num_sub_spaces())])
+
+    if callable(strain):
+        z = mesh.coordinates()[mesh.cells()].mean(axis=1)[:, 2]
+        values = np.asarray(strain(z), dtype=np.float64).reshape(len(dofs), -1)
+    else:
+        values = np.broadcast_to(np.asarray(strain, dtype=np.float64).ravel(), dofs.shape)
+
+    array = function.vector().get_local()
+    owned = dofs < len(array)
+    array[dofs[owned]] = values[owned]
+    function.vector().set_local(array)
+    function.vector().apply("insert")
+
+
+def boundary_surface(points: np.ndarray, tetra: np.ndarray):
+    """
+    Boundary triangles of the (M, 4) tetrahedra tetra, the faces belonging to only one tetrahedron,
+    oriented outward: the vertex of the tetrahedron opposite to the face is behind it.
+    Return the (n,) indexes in points of the surface vertices (sorted) and the (F, 3) faces indexing them.
     """
+    tetra = np.asarray(tetra, dtype=np.int64)
+    # Face i of a tetrahedron is opposite to its vertex i
+    faces = tetra[:, [[1, 2, 3], [0, 3, 2], [0, 1, 3], [0, 2, 1]]].reshape(-1, 3)
+    opposite = tetra.reshape(-1)
+
+    key = np.ascontiguousarray(np.sort(faces, axis=1))
+    _, index, counts = np.unique(key.view(np.dtype((np.void, key.dtype.itemsize * 3))).ravel(),
+                                 return_index=True, return_counts=True)
+    boundary = index[counts == 1]
+    faces, opposite = faces[boundary], opposite[boundary]
+
+    triangles = np.asarray(points)[faces]
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    inward = np.einsum("ij,ij->i", normals, np.asarray(points)[opposite] - triangles[:, 0]) > 0
+    faces[inward] = faces[inward][:, [0, 2, 1]]
+
+    vertex_index, faces = np.unique(faces, return_inverse=True)
+    return vertex_index, faces.reshape(-1, 3)
 
-    # Add a variable for the input file
-    # Add variable for the output folder
-    k=5.0e0 # clamping at z< z_clamping_tolerance, support rigidity
-    z_clamping_tolerance = 0.1 # ALL nodes with a z lower than his values will be considered as supports
-    tol = 1.0e-10
-    E = 1.0
-    nu = 0.3
-    mu = E/(2.0*(1.0 + nu))
-    lmbda = E*nu/((1.0 + nu)*(1.0 - 2.0*nu))
-    name = Path(input.stem)
 
-    #https://fenicsproject.discourse.group/t/transitioning-from-mesh-xml-to-mesh-xdmf-from-dolfin-convert-to-meshio/412/2
-    #https://fenicsproject.discourse.group/t/pygmsh-tutorial/2506/4
+def surface_map(boundary_vertices: np.ndarray, surface_vertices: np.ndarray, tolerance: float = 1.0e-5):
+    """
+    Index of the nearest boundary vertex of the solution for every vertex of the original surface (the generated obj),
+    found once per mesh with a KD-tree, so the labels can be sampled in the original vertex order.
+    Raise a ValueError if a surface vertex is further than tolerance (relative to the part size) from the boundary
+    vertices, the tetra mesh did not keep the surface vertices.
+    """
+    distance, index = cKDTree(boundary_vertices).query(surface_vertices)
+    size = np.ptp(surface_vertices, axis=0).max()
+    if distance.max() > tolerance * size:
+        raise ValueError(f"Surface vertex {distance.argmax()} is {distance.max():.2e} away from the tetra mesh boundary")
+    return index
+
+
+def build_nullspace(V, x):
+    """
+    Rigid body modes of the vector function space V (3 translations, 3 rotations), used as near-nullspace by AMG.
+    """
+    nullspace_basis = [x.copy() for i in range(6)]
+
+    # Build translational null space basis
+    V.sub(0).dofmap().set(nullspace_basis[0], 1.0)
+    V.sub(1).dofmap().set(nullspace_basis[1], 1.0)
+    V.sub(2).dofmap().set(nullspace_basis[2], 1.0)
+
+    # Build rotational null space basis
+    V.sub(0).set_x(nullspace_basis[3], -1.0, 1)
+    V.sub(1).set_x(nullspace_basis[3],  1.0, 0)
+    V.sub(0).set_x(nullspace_basis[4],  1.0, 2)
+    V.sub(2).set_x(nullspace_basis[4], -1.0, 0)
+    V.sub(2).set_x(nullspace_basis[5],  1.0, 1)
+    V.sub(1).set_x(nullspace_basis[5], -1.0, 2)
+
+    for x in nullspace_basis:
+        x.apply("insert")
+
+    basis = VectorSpaceBasis(nullspace_basis)
+    basis.orthonormalize()
+    return basis
+
+
+def read_msh(input: Path):
+    """
+    Read the (N, 3) nodes and (M, 4) tetrahedra of the msh file input.
+    """
     msh = meshio.read(input)
-    logging.info(f"Start simulating {input}")
-    for cell in msh.cells:  
+    for cell in msh.cells:
         if cell.type == "triangle":
             triangle_cells = cell.data
         elif  cell.type == "tetra":
             tetra_cells = cell.data
+    return msh.points, tetra_cells
+
 
-    tetra_mesh = meshio.Mesh(points=msh.points, cells={"tetra": tetra_cells})
-    xdmf_path =  output_folder / name.with_suffix('.xdmf')
-    meshio.write(xdmf_path, tetra_mesh)
+# MeshEditor filled from the arrays in C++, the Python MeshEditor has only a call per vertex and per cell
+MESH_BUILDER_CODE = """
+#include <pybind11/pybind11.h>
+#include <pybind11/eigen.h>
+#include <dolfin/geometry/Point.h>
+#include <dolfin/mesh/CellType.h>
+#include <dolfin/mesh/Mesh.h>
+#include <dolfin/mesh/MeshEditor.h>
+
+using Points = Eigen::Matrix<double, Eigen::Dynamic, 3, Eigen::RowMajor>;
+using Cells = Eigen::Matrix<std::int64_t, Eigen::Dynamic, 4, Eigen::RowMajor>;
+
+void build_tetra_mesh(dolfin::Mesh& mesh, Eigen::Ref<const Points> points, Eigen::Ref<const Cells> cells)
+{
+  dolfin::MeshEditor editor;
+  editor.open(mesh, dolfin::CellType::Type::tetrahedron, 3, 3);
+  editor.init_vertices(points.rows());
+  editor.init_cells(cells.rows());
+  for (Eigen::Index i = 0; i < points.rows(); ++i)
+    editor.add_vertex(i, dolfin::Point(points(i, 0), points(i, 1), points(i, 2)));
+  std::vector<std::size_t> cell(4);
+  for (Eigen::Index i = 0; i < cells.rows(); ++i)
+  {
+    for (int j = 0; j < 4; ++j)
+      cell[j] = cells(i, j);
+    editor.add_cell(i, cell);
+  }
+  editor.close();
+}
+
+PYBIND11_MODULE(SIGNATURE, m)
+{
+  m.def("build_tetra_mesh", &build_tetra_mesh);
+}
+"""
+_mesh_builder = None
+
+
+def mesh_from_arrays(points: np.ndarray, tetra: np.ndarray):
+    """
+    Build a dolfin Mesh from the (N, 3) nodes and (M, 4) tetrahedra arrays, without the xdmf/h5 files round trip.
+    The MeshEditor is filled in C++ (MESH_BUILDER_CODE, compiled once like the forms), so no Python call is made per
+    vertex or per cell. The nodes used by no tetrahedron are dropped, the order of the others is kept.
+    """
+    global _mesh_builder
+    if _mesh_builder is None:
+        _mesh_builder = compile_cpp_code(MESH_BUILDER_CODE)
+    used, tetra = np.unique(np.asarray(tetra).ravel(), return_inverse=True)
+    tetra = np.ascontiguousarray(tetra.reshape(-1, 4), dtype=np.int64)
+    points = np.ascontiguousarray(np.asarray(points, dtype=np.float64)[used])
 
-    mesh_file = XDMFFile(str(xdmf_path))
     mesh = Mesh()
-    mesh_file.read(mesh);
+    _mesh_builder.build_tetra_mesh(mesh, points, tetra)
+    return mesh
 
-    V = VectorFunctionSpace(mesh, 'P', 2)
-    #W = FunctionSpace(mesh, 'P', 1)
-    T = TensorFunctionSpace(mesh, 'DG', 0)
 
-    # Define boundary condition
+def distributed_mesh(points: np.ndarray, tetra: np.ndarray, xdmf_path: Path, comm=None):
+    """
+    Build a dolfin Mesh partitioned over the MPI processes of comm from the nodes and tetrahedra given on rank 0
+    (the other ranks can give None). The MeshEditor only builds local meshes, so rank 0 writes the mesh in the
+    xdmf file xdmf_path, which is read and partitioned by all the ranks.
+    """
+    comm = MPI.comm_world if comm is None else comm
+    if MPI.rank(comm) == 0:
+        used, tetra = np.unique(np.asarray(tetra).ravel(), return_inverse=True)
+        points = np.asarray(points, dtype=np.float64)[used]
+        meshio.write(str(xdmf_path), meshio.Mesh(points, [("tetra", tetra.reshape(-1, 4))]))
+    MPI.barrier(comm)
 
-    class Boundary_Bottom_func(SubDomain):
-        def inside(self, x, on_boundary):
-            return on_boundary and x[2] < z_clamping_tolerance
+    mesh = Mesh(comm)
+    with XDMFFile(comm, str(xdmf_path)) as file:
+        file.read(mesh)
+    return mesh
 
-    class BoundarySides_x_func(SubDomain):
-        def inside(self, x, on_boundary):
-            return on_boundary and near(x[0],-31,0.5)
 
-    Boundary_Bottom = Boundary_Bottom_func()
- 
-    BoundaryMarker = MeshFunction("size_t", mesh, mesh.topology().dim() - 1)
-    BoundaryMarker.set_all(0)
-    Boundary_Bottom.mark(BoundaryMarker, 1)
+class InherentStrainSession:
+    """
+    Inherent strain solver built once and fed meshes in sequence.
+    The material and support constants are dolfin Constants, so the JIT compiled forms are the same for every mesh
+    and compiled only once. The linear solver options are set once, the solver itself is created for each mesh by
+    factorize() as a PETSc solver set up once does not accept an operator of another size.
+    Under mpirun -n K the mesh is partitioned over the K ranks, the linear algebra is distributed and
+    the outputs are written once, as xdmf files, from the partitioned solution.
+    Args:
+        k = 5.0 float, the support rigidity
+        z_clamping_tolerance=0.1 float, all vertices under this z will be considered as supports.
+        E = 1.0 float, Young modulus
+        nu = 0.3 float, Poisson ratio
+        backend = "lu" str, linear solver: "lu" the dolfin default LU solver (MUMPS under MPI),
+            "cholmod" CHOLMOD Cholesky factorization of the stiffness matrix exported to SciPy,
+            the symbolic analysis is reused while the sparsity pattern do not change (serial only),
+            "cg_amg" conjugate gradient preconditioned by algebraic multigrid built from the rigid body modes,
+            uses much less memory than a factorization on large parts
+        tolerance = 1.0e-8 float, relative tolerance of "cg_amg"
+        max_iterations = 1000 int, maximum number of iterations of "cg_amg"
+    """
+    def __init__(self, k: float = 5.0e0, z_clamping_tolerance: float = 0.1, E: float = 1.0, nu: float = 0.3,
+                 backend: str = "lu", tolerance: float = 1.0e-8, max_iterations: int = 1000):
+        self.k = Constant(k)
+        self.mu = Constant(E/(2.0*(1.0 + nu)))
+        self.lmbda = Constant(E*nu/((1.0 + nu)*(1.0 - 2.0*nu)))
+        self.z_clamping_tolerance = z_clamping_tolerance
+        self.backend = backend
+        self.comm = MPI.comm_world
+        self.rank = MPI.rank(self.comm)
+        self.parallel = MPI.size(self.comm) > 1
+        if backend == "lu":
+            self.lu_method = "mumps" if self.parallel else "default"
+        elif backend == "cholmod":
+            if self.parallel:
+                raise ValueError("The cholmod backend is serial, use lu or cg_amg under MPI")
+            self.factor = None # CHOLMOD factor, its symbolic analysis is reused for the same sparsity pattern
+            self.pattern = None
+        elif backend == "cg_amg":
+            # Smoothed aggregation AMG of PETSc, which uses the near-nullspace of the operator
+            PETScOptions.set("mg_levels_ksp_type", "chebyshev")
+            PETScOptions.set("mg_levels_pc_type", "jacobi")
+            PETScOptions.set("mg_levels_esteig_ksp_type", "cg")
+            PETScOptions.set("mg_levels_ksp_chebyshev_esteig_steps", 50)
+            self.tolerance = tolerance
+            self.max_iterations = max_iterations
+        else:
+            raise ValueError(f"Unknown solver backend {backend}")
+
+    def sigma(self, v):
+        return self.lmbda*tr(sym(grad(v)))*Identity(len(v)) + 2.0*self.mu*sym(grad(v))
+
+    def factorize(self, A, V):
+        """
+        Factorize the assembled stiffness matrix A of the space V, the factorization is used by solve_rhs.
+        For "cg_amg", the CG solver and its AMG preconditioner are set up instead.
+        """
+        self.A = A
+        if self.backend == "lu":
+            self.solver = LUSolver(self.lu_method)
+            self.solver.set_operator(A)
+        elif self.backend == "cg_amg":
+            as_backend_type(A).set_near_nullspace(build_nullspace(V, Function(V).vector()))
+            self.solver = PETScKrylovSolver("cg", PETScPreconditioner("petsc_amg"))
+            self.solver.parameters["relative_tolerance"] = self.tolerance
+            self.solver.parameters["maximum_iterations"] = self.max_iterations
+            self.solver.parameters["error_on_nonconvergence"] = True
+            self.solver.set_operator(A)
+        elif self.backend == "cholmod":
+            indptr, indices, data = as_backend_type(A).mat().getValuesCSR()
+            A_csc = scipy.sparse.csr_matrix((data, indices, indptr), shape=(A.size(0), A.size(1))).tocsc()
+            pattern = (A_csc.indptr, A_csc.indices)
+            if self.factor is None or not (np.array_equal(pattern[0], self.pattern[0])
+                                           and np.array_equal(pattern[1], self.pattern[1])):
+                self.factor = sksparse.cholmod.analyze(A_csc)
+                self.pattern = pattern
+            else:
+                logging.debug("\t CHOLMOD symbolic analysis reused")
+            self.factor.cholesky_inplace(A_csc)
+
+    def solve_rhs(self, b, u_sol):
+        """
+        Solve A u = b with the factorization of factorize() and put the result in the Function u_sol.
+        Return the number of iterations ("cg_amg" only) and the relative residual |b - A u| / |b|.
+        """
+        iterations = None
+        if self.backend == "lu":
+            self.solver.solve(u_sol.vector(), b)
+        elif self.backend == "cholmod":
+            u_sol.vector().set_local(self.factor(b.get_local()))
+            u_sol.vector().apply("insert")
+        elif self.backend == "cg_amg":
+            iterations = self.solver.solve(u_sol.vector(), b)
+        residual = (self.A * u_sol.vector() - b).norm("l2") / b.norm("l2")
+        return {"iterations": iterations, "residual": residual}
+
+    def write(self, data, path: Path):
+        """
+        Write the Function or MeshFunction data in path (without suffix): a pvd file in serial,
+        a single xdmf file gathered from all the ranks under MPI.
+        """
+        if self.parallel:
+            with XDMFFile(self.comm, str(path) + ".xdmf") as file:
+                file.write(data)
+        else:
+            file = File(str(path) + ".pvd")
+            file << data
+
+    def load_mesh(self, input: Path, points: np.ndarray = None, tetra: np.ndarray = None, xdmf_path: Path = None):
+        """
+        Read the tetra mesh of input (or use points and tetra) as a dolfin Mesh.
+        Under MPI, only rank 0 reads the mesh (points and tetra are only needed on rank 0), which is partitioned
+        through the xdmf file xdmf_path.
+        """
+        if self.parallel:
+            if self.rank == 0 and (points is None or tetra is None):
+                points, tetra = read_msh(input)
+            return distributed_mesh(points, tetra, xdmf_path, self.comm)
+        if points is None or tetra is None:
+            points, tetra = read_msh(input)
+        return mesh_from_arrays(points, tetra)
+
+    def solve(self, input: Path, output_folder: Path, points: np.ndarray = None, tetra: np.ndarray = None,
+              strains: list = None, write_files: bool = True, return_surface: bool = False, surface: tuple = None) -> dict:
+        """
+        Deform the part of input using the inherent strain methods.
+        Args:
+            input: pathlib.Path, where the input file is (only its name is used if points and tetra are given)
+            output_folder: pathlib.Path, where to save the output files
+            points = None np.ndarray, (N, 3) nodes of the tetra mesh, to skip reading the msh file
+            tetra = None np.ndarray, (M, 4) tetrahedra of the tetra mesh, to skip reading the msh file
+            strains = None list of inherent strains, the load cases solved with the same factorization. Each strain is
+                a (3, 3) tensor or a function of z returning (n, 3, 3) tensors (see set_cell_tensor). With one load case the outputs are named <name>._*, with several <name>_<case>._*
+            write_files = True bool, write the _BoundaryMarker, _InherentStrain and _Displacement files (debug outputs when return_surface is used)
+            return_surface = False bool, also return the surface of the part as arrays (serial only):
+                "vertices" (n, 3), "faces" (F, 3) oriented outward and "displacement" the list of the (n, 3) displacements of the vertices of each load case
+            surface = None (vertices, faces), the original surface of the part (the generated obj). With return_surface,
+                the returned surface is this one and the displacements are given in the order of its vertices (see surface_map)
+        Return the time spent to set up the problem (mesh, spaces, forms, assembly) and to solve it (without writing the files),
+        the number of iterations of the solver ("cg_amg" only) and the relative residual of each load case,
+        the number of dof, tetrahedra and nodes of the mesh, the number of MPI ranks, and the names of the load cases.
+        """
+        if return_surface and self.parallel:
+            raise ValueError("return_surface is not available under MPI")
+        name = Path(input.stem)
+        if self.rank == 0:
+            logging.info(f"Start simulating {input}")
+        start = time.perf_counter()
+
+        mesh = self.load_mesh(input, points, tetra, output_folder / f"{name}._Mesh.xdmf")
+
+        V = VectorFunctionSpace(mesh, 'P', 2)
+        #W = FunctionSpace(mesh, 'P', 1)
+        T = TensorFunctionSpace(mesh, 'DG', 0)
+
+        # Define boundary condition
+        BoundaryMarker = mark_bottom(mesh, self.z_clamping_tolerance)
+
+        if strains is None:
+            strains = [DEFAULT_INHERENT_STRAIN]
+        names = [name] if len(strains) == 1 else [Path(f"{name}_{case}") for case in range(len(strains))]
+        InherentStrainInterp = Function(T)
+
+        u = TrialFunction(V)
+        v = TestFunction(V)
 
-    FileBoundaryMarker = File(str(output_folder / f"{name}._BoundaryMarker.pvd"))
-    FileBoundaryMarker << BoundaryMarker
+        ds = Measure('ds', domain=mesh, subdomain_data=BoundaryMarker)
 
-    def sigma(v):
-        return lmbda*tr(sym(grad(v)))*Identity(len(v)) + 2.0*mu*sym(grad(v))
+        a = inner(self.sigma(u), grad(v))*dx #+ 1.e-5 * inner(u,v) *dx
+        a += self.k*inner(u, v)*ds(1)
 
-    class InherentStrainFunc(UserExpression):
-        def eval(self, value, x):
-            value[0] = -1.0
-            value[1] = 0.
-            value[2] = 0.
-            value[3] = 0.
-            value[4] = -1.0
-            value[5] = 0.
-            value[6] = 0.
-            value[7] = 0.
-            value[8] = -0.5
+        l = inner(InherentStrainInterp,sym(grad(v))) * dx
 
+        A = assemble(a)
+        u_sol = Function(V)
+        u_sol.rename('displacement','displacement')
+        setup_time = time.perf_counter() - start
+        # The output files are written outside the timed sections
+        if write_files:
+            self.write(BoundaryMarker, output_folder / f"{name}._BoundaryMarker")
 
-    InherentStrain = InherentStrainFunc(element=T.ufl_element())
-    InherentStrainInterp = Function(T)
+        # Only one factorization of A for all the load cases
+        start = time.perf_counter()
+        self.factorize(A, V)
+        if return_surface:
+            vertex_index, faces = boundary_surface(mesh.coordinates(), mesh.cells())
+            vertices = mesh.coordinates()[vertex_index]
+            if surface is not None:
+                # Boundary vertex of each original vertex, computed once for all the load cases
+                vertex_index = vertex_index[surface_map(vertices, surface[0])]
+                vertices, faces = surface
+        infos = []
+        displacements = []
+        solve_time = time.perf_counter() - start
+        for case_name, strain in zip(names, strains):
+            start = time.perf_counter()
+            set_cell_tensor(InherentStrainInterp, strain)
+            infos.append(self.solve_rhs(assemble(l), u_sol))
+            if return_surface:
+                # Same vertex values as the ones written in the vtu files
+                displacements.append(u_sol.compute_vertex_values(mesh).reshape(3, -1).T[vertex_index])
+            solve_time += time.perf_counter() - start
 
+            if write_files:
+                self.write(InherentStrainInterp, output_folder / f"{case_name}._InherentStrain")
+                self.write(u_sol, output_folder / f"{case_name}._Displacement")
 
-    InherentStrainInterp.interpolate(InherentStrain)
-    InherentStrain_file = File( str(output_folder / f"{name}._InherentStrain.pvd"))
-    InherentStrain_file << InherentStrainInterp
+        # Under MPI the slowest rank gives the time of the solve
+        setup_time = MPI.max(self.comm, setup_time)
+        solve_time = MPI.max(self.comm, solve_time)
+        iterations = [info["iterations"] for info in infos]
+        residual = [info["residual"] for info in infos]
+        if self.rank == 0:
+            logging.info(f"End simulating {input}, {len(strains)} load cases (setup {setup_time:.2f}s, solve {solve_time:.2f}s, "
+                         f"iterations {iterations}, max residual {max(residual):.2e})")
+        result = {"setup_time": setup_time, "solve_time": solve_time, "iterations": iterations, "residual": residual,
+                  "dof": V.dim(), "tetra": mesh.num_entities_global(3), "nodes": mesh.num_entities_global(0),
+                  "ranks": MPI.size(self.comm), "names": [str(case_name) for case_name in names]}
+        if return_surface:
+            result.update(vertices=np.array(vertices), faces=np.asarray(faces), displacement=displacements)
+        return result
 
-    u = TrialFunction(V)
-    v = TestFunction(V)
 
-    ds = Measure('ds', domain=mesh, subdomain_data=BoundaryMarker)
+def InherentStrain(input: Path, output_folder: Path, k: int = 1.0e8, z_clamping_tolerance: float = 0.1,
+                   points: np.ndarray = None, tetra: np.ndarray = None, session: InherentStrainSession = None,
+                   strains: list = None, write_files: bool = True, return_surface: bool = False, surface: tuple = None):
+    """
+    Function deforming a part using the inherent strain methods.
+    Args:
+        input: pathlib.Path, where the input file is (only its name is used if points and tetra are given)
+        output_folder: pathlib.Path, where to save the output files
+        k = 1.0e8 int, the support rigidity
+        z_clamping_tolerance=0.1 float, all vertices under this z will be considered as supports.
+        points = None np.ndarray, (N, 3) nodes of the tetra mesh, to skip reading the msh file
+        tetra = None np.ndarray, (M, 4) tetrahedra of the tetra mesh, to skip reading the msh file
+        session = None InherentStrainSession, reused between the calls to keep the compiled forms and the solver
+        strains = None list of (3, 3) inherent strain tensors or functions of z, the load cases (default diag(-1, -1, -0.5))
+        write_files = True bool, write the pvd files of the boundary marker, inherent strain and displacement
+        return_surface = False bool, also return the surface vertices, faces and displacements as arrays (see InherentStrainSession.solve)
+        surface = None (vertices, faces), original surface of the part on which the returned displacements are given
+    """
+    if session is None:
+        # Add a variable for the input file
+        # Add variable for the output folder
+        k=5.0e0 # clamping at z< z_clamping_tolerance, support rigidity
+        z_clamping_tolerance = 0.1 # ALL nodes with a z lower than his values will be considered as supports
+        session = InherentStrainSession(k=k, z_clamping_tolerance=z_clamping_tolerance)
+    return session.solve(input, output_folder, points, tetra, strains, write_files, return_surface, surface)
+
+# Environment variables fixing the number of threads of the BLAS and OpenMP libraries
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS",
+                    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+# Session of a solve worker and queue where it reports the part it starts, set by _init_solve_worker
+_session = None
+_solve_queue = None
+
 
-    a = inner(sigma(u), grad(v))*dx #+ 1.e-5 * inner(u,v) *dx
-    a += k*inner(u, v)*ds(1)
+def _init_solve_worker(session_kwargs: dict, status_queue=None):
+    global _session, _solve_queue
+    _solve_queue = status_queue
+    _session = InherentStrainSession(**session_kwargs)
+
+
+def _solve_task(task: tuple):
+    """
+    Simulate the part of task (input, output_folder, strains, mesh_kwargs, solve_kwargs) with the session of the worker.
+    A stl input is first meshed in memory with mesh_kwargs, under the watchdog of mesh_kwargs["timeout"] (s) and
+    mesh_kwargs["max_rss"] (MiB, memory of the whole process). With solve_kwargs["original_surface"], the surface of the obj
+    file next to input is given to the solve.
+    Return (input, result, None) on success and (input, None, traceback) on failure.
+    """
+    input, output_folder, strains, mesh_kwargs, solve_kwargs = task
+    if _solve_queue is not None:
+        # The parent follows the process of each part, to report the parts whose process dies
+        _solve_queue.put({"started": input, "pid": os.getpid()})
+    solve_kwargs = dict(solve_kwargs)
+    try:
+        if solve_kwargs.pop("original_surface", False):
+            obj = trimesh.load(input.with_suffix(".obj"), process=False)
+            solve_kwargs["surface"] = (obj.vertices, obj.faces)
+        points = tetra = None
+        if input.suffix == ".stl":
+            mesh_kwargs = dict(mesh_kwargs or {})
+            timeout, max_rss = mesh_kwargs.pop("timeout", None), mesh_kwargs.pop("max_rss", None)
+            with watchdog(input, timeout, max_rss, _solve_queue):
+                points, tetra = mesh_surface(*weld_triangles(read_stl_triangles(input)), **mesh_kwargs)
+            logging.debug(f"{input} meshed: {mesh_counts(tetra, len(points))}")
+        return input, _session.solve(input, output_folder, points, tetra, strains, **solve_kwargs), None
+    except Exception:
+        return input, None, traceback.format_exc()
+
+
+def solve_many(inputs: list, output_folder: Path, workers: int = 1, threads_per_worker: int = 1, strains: list = None,
+               mesh_kwargs: dict = None, write_files: bool = True, return_surface: bool = False,
+               original_surface: bool = False, **session_kwargs) -> list:
+    """
+    Simulate many parts with a pool of workers processes, each one with its own InherentStrainSession and
+    its BLAS/OpenMP libraries pinned to threads_per_worker threads. A failing part do not stop the others, even when
+    its process dies (killed by the system OOM-killer, crash of a library): the process is replaced and the part reported.
+    Args:
+        inputs: list of pathlib.Path, msh files, or stl files meshed in memory by the workers
+        output_folder: pathlib.Path, where to save the output files
+        workers: int, number of solve processes
+        threads_per_worker: int, number of BLAS and OpenMP threads of each process
+        strains: list of the load cases of each part (see InherentStrainSession.solve)
+        mesh_kwargs: dict, arguments of mesh_surface for the stl inputs (parameters, tetra_target...), and the limits
+            of the meshing "timeout" (s) and "max_rss" (MiB, whole solve process), above them the process is killed
+            and the part reported
+        write_files: bool, write the pvd files of each part
+        return_surface: bool, the results also contain the surface arrays of each part (see InherentStrainSession.solve)
+        original_surface: bool, the surface arrays are the ones of the obj file with the same name as each input
+            (the generated surface), and the displacements are in the order of its vertices
+        session_kwargs: arguments of InherentStrainSession (k, z_clamping_tolerance, backend...)
+    Return the list of (input, result) of each part in the order of inputs, with result None if the part failed.
+    """
+    solve_kwargs = {"write_files": write_files, "return_surface": return_surface, "original_surface": original_surface}
+    tasks = [(Path(input), output_folder, strains, mesh_kwargs, solve_kwargs) for input in inputs]
+    results = {}
 
-    l = inner(InherentStrain,sym(grad(v))) * dx
+    def finish(input, result, error):
+        if error is not None:
+            logging.critical(f"{input} simulation failed:\n{error}")
+        results[input] = result
+        pbar.update()
 
-    u_sol = Function(V)
+    # The workers are spawned, so they load the BLAS and OpenMP libraries with the pinned environment
+    previous = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    os.environ.update({name: str(threads_per_worker) for name in THREAD_VARIABLES})
+    context = mp.get_context("spawn")
+    status_queue = context.SimpleQueue()
+    try:
+        # The pool replaces the dead processes, and is terminated at the end as the tasks of the dead processes are lost
+        with context.Pool(processes=workers, initializer=_init_solve_worker, initargs=(session_kwargs, status_queue)) as pool, \
+                tqdm(total=len(tasks), desc="Computing deformation files") as pbar:
+            pending = {task[0]: pool.apply_async(_solve_task, (task,)) for task in tasks}
+            started = {}  # pid of the process of each started part
+            dead = {}  # time the process of a part was found dead, its result may still be on its way
+            while pending:
+                while not status_queue.empty():
+                    message = status_queue.get()
+                    if "started" in message:
+                        started[message["started"]] = message["pid"]
+                    elif pending.pop(message["stl"], None) is not None:
+                        # Killed by the watchdog of the in memory meshing
+                        finish(message["stl"], None, message["problem"])
+                for input in [i for i, async_result in pending.items() if async_result.ready()]:
+                    finish(*pending.pop(input).get())
+                now = time.monotonic()
+                for input in [i for i in pending if i in started and not process_alive(started[i])]:
+                    if now - dead.setdefault(input, now) >= KILL_GRACE:
+                        pending.pop(input)
+                        finish(input, None, f"the solve process {started[input]} died (killed by the system OOM-killer or crashed)")
+                time.sleep(WATCHDOG_PERIOD)
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
 
-    solve(a == l, u_sol)
+    results = [(task[0], results[task[0]]) for task in tasks]
+    logging.info(f"{sum(result is not None for _, result in results)}/{len(tasks)} parts simulated")
+    return results
 
-    file_displacement = File( str(output_folder / f"{name}._Displacement.pvd"))
-    
-    u_sol.rename('displacement','displacement')
-    file_displacement << u_sol
-    logging.info(f"End simulating {input}")
 
 if __name__ == "__main__":
     input = Path("cube.msh")
     output = Path("results/")
 
-    InherentStrain(input=input, output_folder=output , k=1e8, z_clamping_tolerance=0.1)
\ No newline at end of file
+    InherentStrain(input=input, output_folder=output , k=1e8, z_clamping_tolerance=0.1)
@@ -1,23 +1,119 @@
-from cmath import log
 from pathlib import Path
+import multiprocessing as mp
+import numpy as np
+from tqdm import tqdm
 import trimesh
 import logging
 
-def remove_not_exact(folder_path: Path, edges_target:int = 3000):
+# Binary stl record: normal, 3 vertices and an attribute byte count
+STL_RECORD = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attributes", "<u2")])
+
+
+def read_stl_triangles(file: Path) -> np.ndarray:
+    """
+    Read the triangles of a binary stl straight into a (n, 3, 3) float32 array.
+    Ascii stl (which size do not match the binary header) are loaded with trimesh.
+    """
+    file = Path(file)
+    with open(file, "rb") as f:
+        f.seek(80)
+        header = f.read(4)
+        if len(header) == 4:
+            triangles_number = int(np.frombuffer(header, dtype="<u4")[0])
+            if file.stat().st_size == 84 + triangles_number * STL_RECORD.itemsize:
+                return np.fromfile(f, dtype=STL_RECORD, count=triangles_number)["vertices"]
+    mesh = trimesh.load(file, process=False)
+    return mesh.vertices[mesh.faces].astype(np.float32)
+
+
+def weld_triangles(triangles: np.ndarray):
+    """
+    Turn a triangle soup (n, 3, 3) into (vertices, faces) by welding the vertices with the same coordinates.
+    """
+    # + 0.0 turn -0.0 into 0.0 so both are welded together
+    points = np.ascontiguousarray(triangles.reshape(-1, 3) + np.float32(0.0))
+    _, index, faces = np.unique(points.view(np.dtype((np.void, points.dtype.itemsize * 3))),
+                                return_index=True, return_inverse=True)
+    return points[index], faces.reshape(-1, 3).astype(np.int64)
+
+
+def unique_edges(faces: np.ndarray) -> np.ndarray:
+    """
+    Unique edges (E, 2) of the faces (F, 3), each one as (smallest vertex, largest vertex), sorted.
+    """
+    faces = np.asarray(faces, dtype=np.int64)
+    edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+    vertices_number = faces.max() + 1 if len(faces) else 0
+    keys = np.unique(edges[:, 0] * vertices_number + edges[:, 1])
+    return np.column_stack([keys // vertices_number, keys % vertices_number]) if len(keys) else edges
+
+
+def count_edges(triangles: np.ndarray) -> int:
+    """
+    Number of unique edges of a triangle soup (n, 3, 3), after welding the vertices with the same coordinates.
+    """
+    vertices, faces = weld_triangles(triangles)
+    return len(unique_edges(faces))
+
+
+def stl_edges_number(file: Path):
+    """
+    Return (file, number of unique edges of the stl file), or (file, None) if the file can not be read.
+    """
+    try:
+        return file, count_edges(read_stl_triangles(file))
+    except Exception as e:
+        logging.error(f"{file} could not be read: {e}")
+        return file, None
+
+
+def remove_not_exact(folder_path: Path, edges_target:int = 3000, workers: int = 1, report_path: Path = None):
     """Remove the mesh with the wrong number of edges.
     Args:
         - folder_path Path: folder to check for stl files
         - edges_target: int number of edges to have. If the mesh do not have the good number of edges, the mesh will be removed
+        - workers: int number of processes reading the stl files
+        - report_path: Path if given, a per-file report "file edges_number status" is written there
+    Return the per-file report as a list of (file, edges_number, status), status "kept", "removed" or
+    "unreadable" (the file could not be read, it is reported but left on disk)
     """
-    for file in Path(folder_path).glob("*.stl"):
-        mesh = trimesh.load(file)
-        edges_number = mesh.edges_unique.shape[0]
-        removed_count = 0
-
-        if edges_number != edges_target:
-            # If the number is wrong, delect the obj and the stl
-            file.unlink()
-            file.with_suffix(".obj").unlink
-            removed_count +=1
-    
-    logging.info(f"{removed_count} files where removed due to incorrect edges numbers (target {edges_target})")
\ No newline at end of file
+    files = sorted(Path(folder_path).glob("*.stl"))
+    removed_count = 0
+    unreadable_count = 0
+    report = []
+
+    pool = mp.Pool(processes=workers) if workers > 1 else None
+    try:
+        if pool is None:
+            results = map(stl_edges_number, files)
+        else:
+            results = pool.imap_unordered(stl_edges_number, files, chunksize=16)
+        for file, edges_number in tqdm(results, total=len(files), desc="Checking edges number"):
+            if edges_number is None:
+                # A read error is not a wrong number of edges, the files are kept
+                status = "unreadable"
+                unreadable_count += 1
+            elif edges_number != edges_target:
+                # If the number is wrong, delect the obj and the stl
+                file.unlink()
+                file.with_suffix(".obj").unlink(missing_ok=True)
+                status = "removed"
+                removed_count +=1
+            else:
+                status = "kept"
+            report.append((file, edges_number, status))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    report.sort()
+    if report_path is not None:
+        with open(report_path, "w") as fileout:
+            for file, edges_number, status in report:
+                fileout.write(f"{file.name} {edges_number} {status}\n")
+
+    logging.info(f"{removed_count} files where removed due to incorrect edges numbers (target {edges_target})")
+    if unreadable_count:
+        logging.warning(f"{unreadable_count} files could not be read and were kept")
+    return report
@@ -11,56 +11,106 @@ import random
 import pyvista as pv
 import logging
 import os
+import time
+import traceback
+import multiprocessing as mp
+from functools import partial
 
-def reduce(mesh:trimesh.base.Trimesh, max_faces_number: int, show_evolution: bool= False):
+def _reduce_stepwise(ms: pmMeshSet, max_faces_number: int) -> int:
+    """
+    Reduce the current mesh of ms to max_faces_number faces by walking the face count down a linear ramp.
+    Return the number of decimation filter calls.
+    """
+    short_history = [] # If the number of faces to not decrease, we should stop the reduction as there is a probleme
+    # We will reduce the number of face iteratively using a linear equation ax+b
+    # with x the step number (we would like to to it in at least 10 step)
+
+    # Number of step to smothely reduce the number of vertice
+    number_of_step = (ms.current_mesh().face_number() - max_faces_number) //100
+    if number_of_step < 10:
+        number_of_step = 10
+    elif number_of_step > 10000:
+        number_of_step = 10000
+    logging.debug(f"\t will be reduced in {number_of_step} steps")
+
+    b = ms.current_mesh().face_number()
+    a = (max_faces_number - b) / number_of_step
+    x = 0
+
+    # Simplify the mesh. Only first simplification will be agressive
+    while (ms.current_mesh().face_number() > max_faces_number):
+        if x < number_of_step:
+            numFaces = int(a * x + b)
+        else:
+            numFaces = max_faces_number
+            # Avoid error by making sure that the last step had the exact number of faces
+        if numFaces < max_faces_number:
+            numFaces = max_faces_number
+
+        ms.apply_filter('simplification_quadric_edge_collapse_decimation', targetfacenum=numFaces)
+        x += 1
+        if x % 100 == 0:
+            #print(f"Target {max_faces_number} actual {ms.current_mesh().face_number()} (actual target {numFaces})")
+
+            # If the number of faces to not decrease, we should stop the reduction as there is a probleme
+            short_history.append(ms.current_mesh().face_number())
+            if len(short_history) > 3:
+                if short_history[-1] == short_history[-2] == short_history[-3]:
+                    # if there is no evolution stop
+                    raise Exception("The mesh is not decimable with those parameters")
+    return x
+
+
+def _reduce_exact(ms: pmMeshSet, max_faces_number: int, max_passes: int) -> int:
+    """
+    Reduce the current mesh of ms to max_faces_number faces by targeting the final count directly,
+    then correcting with at most max_passes - 1 extra passes.
+    Return the number of decimation filter calls.
+    """
+    calls = 0
+    while ms.current_mesh().face_number() > max_faces_number:
+        if calls >= max_passes:
+            raise Exception(f"The mesh did not reach {max_faces_number} faces in {max_passes} passes")
+        before = ms.current_mesh().face_number()
+        ms.apply_filter('simplification_quadric_edge_collapse_decimation', targetfacenum=max_faces_number)
+        calls += 1
+        if ms.current_mesh().face_number() == before:
+            # if there is no evolution stop
+            raise Exception("The mesh is not decimable with those parameters")
+
+    if ms.current_mesh().face_number() != max_faces_number:
+        raise Exception(f"The decimation overshot the target: {ms.current_mesh().face_number()} faces instead of {max_faces_number}")
+    return calls
+
+
+def reduce(mesh:trimesh.base.Trimesh, max_faces_number: int, show_evolution: bool= False, mode: str = "exact",
+           max_passes: int = 5):
     """
     Take a trimesh mesh and reduce his number of faces to reach max_faces_number. 
+    Args:
+        mesh: trimesh.base.Trimesh, mesh to reduce
+        max_faces_number: int, number of faces to reach
+        mode: str = "exact" "exact" target max_faces_number in one decimation and correct it in at most max_passes passes,
+            "stepwise" walk the face count down a linear ramp (up to 10000 decimations)
+        max_passes: int = 5 Maximum number of decimations in the "exact" mode
+    The number of filter calls and the time spent are logged and stored in mesh.metadata["decimation"].
     """
     m = pmMesh(mesh.vertices, mesh.faces)
     del mesh
     ms = pmMeshSet()
     ms.add_mesh(m,"part")
 
-    short_history = [] # If the number of faces to not decrease, we should stop the reduction as there is a probleme
     # If there is too mutch faces:
     if ms.current_mesh().face_number() > max_faces_number:
-        # We will reduce the number of face iteratively using a linear equation ax+b
-        # with x the step number (we would like to to it in at least 10 step)
-
-        # Number of step to smothely reduce the number of vertice
-        number_of_step = (ms.current_mesh().face_number() - max_faces_number) //100
-        if number_of_step < 10:
-            number_of_step = 10
-        elif number_of_step > 10000:
-            number_of_step = 10000
-        logging.debug(f"\t will be reduced in {number_of_step} steps")
-
-        b = ms.current_mesh().face_number()
-        a = (max_faces_number - b) / number_of_step
-        x = 0
-        count = 0
-
-        # Simplify the mesh. Only first simplification will be agressive
-        while (ms.current_mesh().face_number() > max_faces_number):
-            if x < number_of_step:
-                numFaces = int(a * x + b)
-            else:
-                numFaces = max_faces_number
-                # Avoid error by making sure that the last step had the exact number of faces
-            if numFaces < max_faces_number:
-                numFaces = max_faces_number
-
-            ms.apply_filter('simplification_quadric_edge_collapse_decimation', targetfacenum=numFaces)
-            x += 1
-            if x % 100 == 0:
-                #print(f"Target {max_faces_number} actual {ms.current_mesh().face_number()} (actual target {numFaces})")
-
-                # If the number of faces to not decrease, we should stop the reduction as there is a probleme
-                short_history.append(ms.current_mesh().face_number())
-                if len(short_history) > 3:
-                    if short_history[-1] == short_history[-2] == short_history[-3]:
-                        # if there is no evolution stop
-                        raise Exception("The mesh is not decimable with those parameters")
+        start = time.perf_counter()
+        if mode == "exact":
+            filter_calls = _reduce_exact(ms, max_faces_number, max_passes)
+        elif mode == "stepwise":
+            filter_calls = _reduce_stepwise(ms, max_faces_number)
+        else:
+            raise ValueError(f"Unknown reduction mode {mode}")
+        elapsed = time.perf_counter() - start
+        logging.debug(f"\t reduced to {ms.current_mesh().face_number()} faces in {filter_calls} filter calls ({elapsed:.3f}s)")
 
     else:
         msg = " do not have enough faces, skipped"
@@ -71,11 +121,143 @@ def reduce(mesh:trimesh.base.Trimesh, max_faces_number: int, show_evolution: boo
     face_array_matrix = m.face_matrix()
 
     mesh = trimesh.Trimesh(vertices=vertex_array_matrix, faces=face_array_matrix, process=False)
+    mesh.metadata["decimation"] = {"mode": mode, "filter_calls": filter_calls, "time": elapsed}
     return mesh
 
 
+def _sample_seed(seed: int, index: int, attempt: int = 0) -> int:
+    """
+    Seed used by the attempt number attempt of the sample number index. It only depends on (seed, index, attempt),
+    so a sample is the same whatever the number of workers or the order in which the samples are processed.
+    """
+    return int(np.random.SeedSequence([seed, index, attempt]).generate_state(1)[0])
+
+
+def _make_cube(rng: random.Random, sample_seed: int, noise: float, height_max: float, height_min: float,
+               max_edge_size: float, number_of_vert: int, reduce_mode: str = "exact") -> trimesh.Trimesh:
+    """
+    Create one random box, subdivided, noised and decimated to number_of_vert faces.
+    """
+    z_lenght = rng.uniform(height_min, height_max)
+    x_lenght = rng.uniform(height_min, height_max)
+    y_lenght = rng.uniform(height_min, height_max)
+    box = trimesh.creation.box(extents=(x_lenght, y_lenght, z_lenght))
+
+    vert , faces = trimesh.remesh.subdivide_to_size(box.vertices, box.faces, max_edge=max_edge_size)
+    logging.debug("\t subdivision finished")
+
+    box = trimesh.base.Trimesh(vertices =vert  , faces = faces)
+    box = trimesh.permutate.noise(box, noise, seed=sample_seed)
+    logging.debug("\t noised added")
+    box = reduce(box, number_of_vert, mode=reduce_mode)
+    logging.debug("\t reduce finished")
+    return box
+
+
+def _make_polygon(rng: random.Random, sample_seed: int, noise: float, height_max: float, height_min: float,
+                  max_edge_size: float, number_of_vert: int, reduce_mode: str = "exact") -> trimesh.Trimesh:
+    """
+    Create one random extruded polygon, subdivided, noised and decimated to number_of_vert faces.
+    """
+    height = rng.uniform(height_min, height_max)
+    segments = rng.randint(4,10)
+    radius = rng.uniform(height_min, height_max)
+    polygon = trimesh.path.polygons.random_polygon(segments= segments, radius = radius, seed=sample_seed)
+    extrusion = trimesh.primitives.Extrusion(polygon=polygon, height = height)
+    vert , faces = trimesh.remesh.subdivide_to_size(extrusion.vertices, extrusion.faces, max_edge=max_edge_size)
+    logging.debug("\t subdivision finished")
+
+    box = trimesh.base.Trimesh(vertices =vert  , faces = faces)
+    box = trimesh.permutate.noise(box, noise, seed=sample_seed)
+    logging.debug("\t noised added")
+    box = reduce(box, number_of_vert, mode=reduce_mode)
+    logging.debug("\t reduce finished")
+    return box
+
+
+def _generate_sample(i: int, make_shape, path: Path, seed: int, valid_edges: int = None, retries: int = 0,
+                     **shape_kwargs):
+    """
+    Create and export the sample number i with make_shape.
+    If valid_edges is given, the shape is checked in memory and generated again (at most retries times) while
+    it do not have valid_edges unique edges, so rejected shapes are never written.
+    Return (i, None) on success and (i, traceback) on failure, so the failure can be logged by the caller
+    whatever the process the sample ran in.
+    """
+    try:
+        for attempt in range(retries + 1):
+            logging.debug(f"sample N {i}: starting dimension generation (attempt {attempt})")
+            sample_seed = _sample_seed(seed, i, attempt)
+            try:
+                box = make_shape(random.Random(sample_seed), sample_seed, **shape_kwargs)
+            except Exception as e:
+                logging.debug(f"sample N {i}: attempt {attempt} failed: {e}")
+                if attempt == retries:
+                    raise
+                continue
+
+            if valid_edges is None:
+                break
+            # Count the edges as they will be read back from the stl, with the duplicated vertices merged
+            edges_number = trimesh.Trimesh(vertices=box.vertices, faces=box.faces).edges_unique.shape[0]
+            if edges_number == valid_edges:
+                break
+            logging.debug(f"sample N {i}: attempt {attempt} rejected, {edges_number} edges instead of {valid_edges}")
+        else:
+            raise Exception(f"No shape with {valid_edges} edges found in {retries + 1} attempts")
+
+        # Put z_min = z_mov = 0
+        z_min = - min(box.vertices[:,2])
+        z_mov = trimesh.transformations.translation_matrix(direction=[0,0,z_min])
+        box.apply_transform(z_mov)
+        export_path = path / f"{i}.obj"
+        box.export(export_path)
+        box.export(export_path.with_suffix(".stl"))
+        # remove the first line of the obj, with is a comment and made GMSH crash
+        #os.system(f"sed -i '1d' {export_path}")
+        logging.debug(f"sample N {i}: Finished")
+        return i, None
+    except Exception:
+        return i, traceback.format_exc()
+
+
+def _run_generation(make_shape, path: Path, number_sample: int, seed: int = None, workers: int = 1,
+                    valid_edges: int = None, retries: int = 0, **shape_kwargs) -> list:
+    """
+    Generate number_sample shapes with make_shape, in this process (workers=1) or in a pool of workers processes.
+    If seed is None, a random one is drawn and logged so the run can be reproduced.
+    Return the sorted indexes of the samples that could not be generated.
+    """
+    if seed is None:
+        seed = random.SystemRandom().randrange(2**32)
+    logging.info(f"Generating {number_sample} samples with {make_shape.__name__} (seed {seed}, {workers} workers)")
+
+    task = partial(_generate_sample, make_shape=make_shape, path=path, seed=seed, valid_edges=valid_edges,
+                   retries=retries, **shape_kwargs)
+    failed = []
+    pool = mp.Pool(processes=workers) if workers > 1 else None
+    try:
+        if pool is None:
+            results = map(task, range(number_sample))
+        else:
+            results = pool.imap_unordered(task, range(number_sample))
+        for i, error in tqdm(results, total=number_sample):
+            if error is not None:
+                logging.critical(f"sample N {i} failed:\n{error}")
+                failed.append(i)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    logging.info(f"{number_sample - len(failed)}/{number_sample} samples generated")
+    return sorted(failed)
+
+
 def generate_cubes(path: Path, number_sample: int = 1, noise: float = 0.001, name_prefix: str = "cube_", 
-                    height_max: float = 30, height_min: float = 10 ,  max_edge_size: float = 1.0 ,number_of_vert: int = 1500):
+                    height_max: float = 30, height_min: float = 10 ,  max_edge_size: float = 1.0 ,number_of_vert: int = 1500,
+                    workers: int = 1, seed: int = None, reduce_mode: str = "exact", edges_target: int = None,
+                    retries: int = 10) -> list:
     """
     Generate number_samble cubes with random dimension.
     Args:
@@ -87,39 +269,121 @@ def generate_cubes(path: Path, number_sample: int = 1, noise: float = 0.001, nam
         height_min: float = 10 Minimum size of the cubes (not just height, deep and width of the cubes)
         max_edge_size: float = 1.0 Maximum size of the edges BEFORE the decimation
         number_of_vert: int = 1500 Number of faces AFTER the decimation (will change the max edge size of the mesh)
+        workers: int = 1 Number of processes generating the cubes in parallel
+        seed: int = None Seed of the generation, each cube is seeded from (seed, index) so the result do not depend on workers
+        reduce_mode: str = "exact" Decimation mode of reduce(), "exact" or "stepwise"
+        edges_target: int = None If given, only the shapes with this number of edges are saved
+        retries: int = 10 Number of new shapes tried for a sample before giving up when edges_target is not reached
+    Return the indexes of the samples that could not be generated.
+    """
+    return _run_generation(_make_cube, path, number_sample, seed=seed, workers=workers, valid_edges=edges_target,
+                           retries=retries, noise=noise, height_max=height_max, height_min=height_min,
+                           max_edge_size=max_edge_size, number_of_vert=number_of_vert, reduce_mode=reduce_mode)
+
+def _box_grid(extents, faces_target: int) -> list:
+    """
+    Number of grid cells along each axis of a box so that the 4 * (nx*ny + nx*nz + ny*nz) triangles of the grid
+    stay under faces_target. Cells are kept as square as possible, so the number of triangles of each box face is
+    proportional to its area.
+    """
+    n = [1, 1, 1]
+    cells = lambda n: n[0]*n[1] + n[0]*n[2] + n[1]*n[2]
+    while True:
+        # Refine first the axis with the longest cells
+        for axis in np.argsort([-e / k for e, k in zip(extents, n)]):
+            trial = list(n)
+            trial[axis] += 1
+            if 4 * cells(trial) <= faces_target:
+                n = trial
+                break
+        else:
+            return n
+
+
+def box_surface(extents, edges_target: int) -> trimesh.Trimesh:
+    """
+    Triangulate the surface of a box centered on the origin with exactly edges_target unique edges.
+    Each box face is a regular grid of quads split in 2 triangles, the remaining edges are added by inserting a
+    vertex at the center of evenly spread quads (+2 faces and +3 edges each).
+    Args:
+        extents: (x, y, z) size of the box
+        edges_target: int, number of edges of the mesh, must be a multiple of 3 and at least 18
+    """
+    # Closed genus 0 triangulation: 3F = 2E and V - E + F = 2
+    if edges_target % 3 != 0 or edges_target < 18:
+        raise ValueError(f"A closed box surface can not have {edges_target} edges (multiple of 3, at least 18)")
+    faces_target = 2 * edges_target // 3
+    extents = np.asarray(extents, dtype=np.float64)
+    n = _box_grid(extents, faces_target)
+
+    # Quads of the 6 box faces as integer lattice points, ordered counter clockwise seen from outside
+    quads = []
+    for axis in range(3):
+        u, v = (axis + 1) % 3, (axis + 2) % 3
+        iu, iv = np.meshgrid(np.arange(n[u]), np.arange(n[v]), indexing="ij")
+        for side in (0, n[axis]):
+            pts = np.zeros((iu.size, 4, 3), dtype=np.int64)
+            pts[:, :, axis] = side
+            for c, (du, dv) in enumerate(((0, 0), (1, 0), (1, 1), (0, 1))):
+                pts[:, c, u] = iu.ravel() + du
+                pts[:, c, v] = iv.ravel() + dv
+            if side == 0:
+                pts = pts[:, ::-1]
+            quads.append(pts)
+    quads = np.concatenate(quads)
+    lattice, inverse = np.unique(quads.reshape(-1, 3), axis=0, return_inverse=True)
+    quads = inverse.reshape(-1, 4)
+    vertices = lattice * (extents / n) - extents / 2
+
+    # Insert a center vertex in the quads needed to reach faces_target
+    split_number = (faces_target - 4 * (n[0]*n[1] + n[0]*n[2] + n[1]*n[2])) // 2
+    split = np.zeros(len(quads), dtype=bool)
+    split[np.linspace(0, len(quads), split_number, endpoint=False).astype(np.int64)] = True
+
+    plain = quads[~split]
+    faces = [plain[:, [0, 1, 2]], plain[:, [0, 2, 3]]]
+    fan = quads[split]
+    centers = np.arange(len(vertices), len(vertices) + len(fan))
+    vertices = np.vstack([vertices, vertices[fan].mean(axis=1)])
+    for c in range(4):
+        faces.append(np.column_stack([fan[:, c], fan[:, (c + 1) % 4], centers]))
+
+    return trimesh.Trimesh(vertices=vertices, faces=np.concatenate(faces), process=False)
+
+
+def _make_exact_cube(rng: random.Random, sample_seed: int, height_max: float, height_min: float,
+                     edges_target: int) -> trimesh.Trimesh:
+    """
+    Create one random box triangulated directly with edges_target edges.
+    """
+    z_lenght = rng.uniform(height_min, height_max)
+    x_lenght = rng.uniform(height_min, height_max)
+    y_lenght = rng.uniform(height_min, height_max)
+    return box_surface((x_lenght, y_lenght, z_lenght), edges_target)
+
+
+def generate_exact_cubes(path: Path, number_sample: int = 1, edges_target: int = 3000,
+                         height_max: float = 30, height_min: float = 10, workers: int = 1, seed: int = None) -> list:
+    """
+    Generate number_samble cubes with random dimension, triangulated directly with edges_target edges.
+    No subdivision, noise or decimation is needed, and no mesh is rejected by remove_not_exact.
+    Args:
+        path: pathlib.Path: where to save the result
+        number_sample: int, how many cubes to generate
+        edges_target: int = 3000 Number of edges of each cube (multiple of 3)
+        height_max: float = 30 Maximum size of the cubes (not just height, deep and width of the cubes)
+        height_min: float = 10 Minimum size of the cubes (not just height, deep and width of the cubes)
+        workers: int = 1 Number of processes generating the cubes in parallel
+        seed: int = None Seed of the generation, each cube is seeded from (seed, index) so the result do not depend on workers
+    Return the indexes of the samples that could not be generated.
     """
-    for i in tqdm(range(number_sample), total=number_sample):
-        try:
-            logging.debug(f"cubes N {i}: starting dimension generation")
-            z_lenght = random.uniform(height_min, height_max)
-            x_lenght = random.uniform(height_min, height_max)
-            y_lenght = random.uniform(height_min, height_max)
-            box = trimesh.creation.box(extents=(x_lenght, y_lenght, z_lenght))
-
-            vert , faces = trimesh.remesh.subdivide_to_size(box.vertices, box.faces, max_edge=max_edge_size)
-            logging.debug(f"cubes N {i}: subdivision finished")
-
-            box = trimesh.base.Trimesh(vertices =vert  , faces = faces)
-            box = trimesh.permutate.noise(box, noise)
-            logging.debug(f"cubes N {i}: noised added")
-            box = reduce(box, number_of_vert)
-            logging.debug(f"cubes N {i}: reduce finished")
-
-            # Put z_min = z_mov = 0
-            z_min = - min(box.vertices[:,2])
-            z_mov = trimesh.transformations.translation_matrix(direction=[0,0,z_min])
-            box.apply_transform(z_mov)
-            export_path = path / f"{i}.obj"     
-            box.export(export_path)
-            box.export(export_path.with_suffix(".stl"))
-            # remove the first line of the obj, with is a comment and made GMSH crash
-            #os.system(f"sed -i '1d' {export_path}")
-            logging.debug(f"cubes N {i}: Finished")
-        except Exception as e:
-            logging.critical(e, exc_info=True)
+    return _run_generation(_make_exact_cube, path, number_sample, seed=seed, workers=workers, valid_edges=edges_target,
+                           height_max=height_max, height_min=height_min, edges_target=edges_target)
 
 def generate_polygon(path: Path, number_sample: int = 1, noise: float = 0.001, name_prefix: str = "cube_", 
-                    height_max: float = 30, height_min: float = 10 ,  max_edge_size: float = 1.0 ,number_of_vert: int = 1500):
+                    height_max: float = 30, height_min: float = 10 ,  max_edge_size: float = 1.0 ,number_of_vert: int = 1500,
+                    workers: int = 1, seed: int = None, reduce_mode: str = "exact", edges_target: int = None,
+                    retries: int = 10) -> list:
     """
     Generate number_samble polygon with random dimension and number of edges.
     Args:
@@ -131,34 +395,13 @@ def generate_polygon(path: Path, number_sample: int = 1, noise: float = 0.001, n
         height_min: float = 10 Minimum size of the cubes (not just height, deep and width of the cubes)
         max_edge_size: float = 1.0 Maximum size of the edges BEFORE the decimation
         number_of_vert: int = 1500 Number of faces AFTER the decimation (will change the max edge size of the mesh)
+        workers: int = 1 Number of processes generating the polygons in parallel
+        seed: int = None Seed of the generation, each polygon is seeded from (seed, index) so the result do not depend on workers
+        reduce_mode: str = "exact" Decimation mode of reduce(), "exact" or "stepwise"
+        edges_target: int = None If given, only the shapes with this number of edges are saved
+        retries: int = 10 Number of new shapes tried for a sample before giving up when edges_target is not reached
+    Return the indexes of the samples that could not be generated.
     """
-    for i in tqdm(range(number_sample), total=number_sample):
-        try:
-            logging.debug(f"cubes N {i}: starting dimension generation")
-            height = random.uniform(height_min, height_max)
-            segments = random.randint(4,10)
-            radius = random.uniform(height_min, height_max)
-            polygon = trimesh.path.polygons.random_polygon(segments= segments, radius = radius)
-            extrusion = trimesh.primitives.Extrusion(polygon=polygon, height = height)
-            vert , faces = trimesh.remesh.subdivide_to_size(extrusion.vertices, extrusion.faces, max_edge=max_edge_size)
-
-            logging.debug(f"cubes N {i}: subdivision finished")
-
-            box = trimesh.base.Trimesh(vertices =vert  , faces = faces)
-            box = trimesh.permutate.noise(box, noise)
-            logging.debug(f"cubes N {i}: noised added")
-            box = reduce(box, number_of_vert)
-            logging.debug(f"cubes N {i}: reduce finished")
-
-            # Put z_min = z_mov = 0
-            z_min = - min(box.vertices[:,2])
-            z_mov = trimesh.transformations.translation_matrix(direction=[0,0,z_min])
-            box.apply_transform(z_mov)
-            export_path = path / f"{i}.obj"     
-            box.export(export_path)
-            box.export(export_path.with_suffix(".stl"))
-            # remove the first line of the obj, with is a comment and made GMSH crash
-            #os.system(f"sed -i '1d' {export_path}")
-            logging.debug(f"cubes N {i}: Finished")
-        except Exception as e:
-            logging.critical(e, exc_info=True)
+    return _run_generation(_make_polygon, path, number_sample, seed=seed, workers=workers, valid_edges=edges_target,
+                           retries=retries, noise=noise, height_max=height_max, height_min=height_min,
+                           max_edge_size=max_edge_size, number_of_vert=number_of_vert, reduce_mode=reduce_mode)
@@ -0,0 +1,206 @@
+import logging
+import multiprocessing as mp
+from pathlib import Path
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+import pyvista as pv
+import trimesh
+from tqdm import tqdm
+from check_edges_number import STL_RECORD
+from dataset_shards import SHARD_ARRAYS, write_shard, write_index
+from edge_topology import edge_topology
+
+# Per-sample file formats, the "shards" format packs all the samples in binary shards (see dataset_shards)
+FILE_FORMATS = ("vtk", "stl", "obj", "txt")
+FORMATS = ("shards",) + FILE_FORMATS
+
+
+def write_stl(path: Path, vertices: np.ndarray, faces: np.ndarray, binary: bool = True):
+    """
+    Write the surface (vertices, faces) as a stl file, binary by default (written in one block from a record array).
+    """
+    if not binary:
+        with open(path, "w") as fileout:
+            fileout.write(trimesh.exchange.stl.export_stl_ascii(trimesh.Trimesh(vertices, faces, process=False)))
+        return
+    triangles = np.asarray(vertices, dtype=np.float64)[faces]
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), np.finfo(np.float64).tiny)
+
+    records = np.zeros(len(faces), dtype=STL_RECORD)
+    records["normal"] = normals
+    records["vertices"] = triangles
+    with open(path, "wb") as fileout:
+        fileout.write(np.zeros(80, dtype=np.uint8).tobytes())
+        fileout.write(np.uint32(len(faces)).tobytes())
+        fileout.write(records.tobytes())
+
+
+def orient_faces(vertices: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """
+    Return faces with a consistent winding, oriented outward, without walking the mesh face by face.
+    Two faces sharing an edge are consistent when they use it in opposite directions. Each face gets two states
+    (kept, flipped) and the states compatible with the neighbours are linked: the connected components of this graph
+    give the flips making each shell consistent. Then the shells with a negative volume are flipped.
+    Expect closed manifold shells (each edge shared by two faces).
+    """
+    faces = np.array(faces, dtype=np.int64)
+    faces_number = len(faces)
+    half_edges = faces[:, [[0, 1], [1, 2], [2, 0]]].reshape(-1, 2)
+    face_of = np.repeat(np.arange(faces_number), 3)
+
+    # Pairs of half-edges of the same edge
+    edges = np.sort(half_edges, axis=1)
+    keys = edges[:, 0] * (faces.max() + 1) + edges[:, 1]
+    order = np.argsort(keys, kind="stable")
+    pairs = np.flatnonzero(keys[order][1:] == keys[order][:-1])
+    first, second = order[pairs], order[pairs + 1]
+    # 1 if the two faces use the edge in the same direction, one of them must be flipped
+    opposite_state = (half_edges[first, 0] == half_edges[second, 0]).astype(np.int64)
+    face_1, face_2 = face_of[first], face_of[second]
+
+    # Node f is the face f kept, node f + faces_number the face f flipped
+    rows = np.concatenate([face_1, face_1 + faces_number])
+    cols = np.concatenate([face_2 + faces_number * opposite_state, face_2 + faces_number * (1 - opposite_state)])
+    graph = scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(2 * faces_number, 2 * faces_number))
+    _, labels = connected_components(graph, directed=False)
+    kept, flipped = labels[:faces_number], labels[faces_number:]
+    # The states of a shell are two components, the one with the smallest label is used
+    flip = flipped < kept
+    faces[flip] = faces[flip][:, [0, 2, 1]]
+
+    # Outward: positive signed volume of each shell
+    shell = np.minimum(kept, flipped)
+    triangles = np.asarray(vertices, dtype=np.float64)[faces]
+    volumes = np.einsum("ij,ij->i", triangles[:, 0], np.cross(triangles[:, 1], triangles[:, 2]))
+    inward = np.bincount(shell, weights=volumes) < 0
+    flip = inward[shell]
+    faces[flip] = faces[flip][:, [0, 2, 1]]
+    return faces
+
+
+def sample_arrays(vertices: np.ndarray, faces: np.ndarray, displacement: np.ndarray) -> dict:
+    """
+    Arrays of a sample stored in the shards (SHARD_ARRAYS), with the precomputed edge topology (see edge_topology).
+    """
+    return {"vertices": vertices, "faces": faces, **edge_topology(vertices, faces), "displacement": displacement}
+
+
+def export_sample(sample: tuple, folder: Path, formats: tuple = ("stl",), binary_stl: bool = True):
+    """
+    Write the per-sample files of sample (name, vertices, faces, displacement) requested in formats
+    ("vtk", "stl", "obj", "txt") from the arrays, each format is built only if requested.
+    """
+    name, vertices, faces, displacement = sample
+    folder = Path(folder)
+    if "vtk" in formats:
+        mesh = pv.PolyData(np.asarray(vertices), np.column_stack([np.full(len(faces), 3), faces]).ravel())
+        mesh.point_data["displacement"] = displacement
+        mesh.save(folder / f"{name}.vtk")
+    if "stl" in formats:
+        write_stl(folder / f"{name}.stl", vertices, faces, binary_stl)
+    if "obj" in formats:
+        trimesh.Trimesh(vertices=vertices, faces=faces, process=False).export(folder / f"{name}.obj")
+    if "txt" in formats:
+        # Displacement label
+        np.savetxt(folder / f"{name}.txt", displacement)
+
+
+def _export_task(task: tuple):
+    """
+    Export the chunk of samples of task (shard, start, samples, folder, options) in a single pass: the faces are oriented
+    (options["fix_normals"]), the per-sample files options["formats"] are written and, if shard is not None, the arrays
+    stored in the shards are computed (see sample_arrays).
+    Return (shard, start, exported) with exported the list of (name, arrays) of the samples, arrays None without shard.
+    """
+    shard, start, samples, folder, options = task
+    exported = []
+    for name, vertices, faces, displacement in samples:
+        if options["fix_normals"]:
+            faces = orient_faces(vertices, faces)
+        export_sample((name, vertices, faces, displacement), folder, options["formats"], options["binary_stl"])
+        arrays = None
+        if shard is not None:
+            arrays = {array_name: np.asarray(array, dtype=SHARD_ARRAYS[array_name])
+                      for array_name, array in sample_arrays(vertices, faces, displacement).items()}
+        exported.append((name, arrays))
+    return shard, start, exported
+
+
+def _write_shard_task(task: tuple):
+    """
+    Concatenate and write the shard of task (folder, shard, exported, compress), exported being the list of
+    (name, arrays) of its samples in order.
+    """
+    folder, shard, exported, compress = task
+    buffers = {array_name: [arrays[array_name] for _, arrays in exported] for array_name in SHARD_ARRAYS}
+    write_shard(folder, shard, [name for name, _ in exported], buffers, compress)
+
+
+def export_samples(samples: list, folder: Path, formats: tuple = ("shards",), workers: int = 1, binary_stl: bool = True,
+                   compress: bool = False, samples_per_shard: int = 1000, chunksize: int = 16, fix_normals: bool = True):
+    """
+    Export the samples in a single pass over the in-memory arrays with a pool of workers, nothing is read from the disk.
+    Args:
+        samples: list of (name, vertices, faces, displacement)
+        folder: pathlib.Path, where the dataset is written
+        formats: tuple of the formats to write, among "shards" (binary shards, see dataset_shards) and the per-sample
+            files "vtk", "stl", "obj", "txt"
+        workers: int, number of export processes
+        binary_stl: bool, write binary stl files (ascii if False)
+        compress: bool, write compressed npz shards
+        samples_per_shard: int, number of samples of each shard
+        chunksize: int, number of samples prepared by a worker task (normals, edge topology, per-sample files)
+        fix_normals: bool, give the faces a consistent outward winding before writing them (see orient_faces)
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown export formats {sorted(unknown)}, available: {FORMATS}")
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+
+    # The samples are prepared by chunks, each one for all the formats, and only the shards are concatenated and
+    # written once all their chunks are back. A chunk never spans two shards.
+    with_shards = "shards" in formats
+    options = {"formats": tuple(f for f in formats if f in FILE_FORMATS), "binary_stl": binary_stl,
+               "fix_normals": fix_normals}
+    shard_starts = range(0, len(samples), samples_per_shard) if with_shards else [0]
+    shard_sizes = {}
+    tasks = []
+    for shard, shard_start in enumerate(shard_starts):
+        shard_end = min(shard_start + samples_per_shard, len(samples)) if with_shards else len(samples)
+        shard_sizes[shard] = shard_end - shard_start
+        tasks += [(shard if with_shards else None, start, samples[start:min(start + chunksize, shard_end)], folder, options)
+                  for start in range(shard_start, shard_end, chunksize)]
+    shards = len(shard_starts) if with_shards else 0
+
+    pool = mp.Pool(processes=workers) if workers > 1 else None
+    try:
+        results = map(_export_task, tasks) if pool is None else pool.imap_unordered(_export_task, tasks)
+        chunks = {}  # chunks received of each shard not written yet, by start
+        writes = []
+        with tqdm(total=len(samples), desc="Creating the final dataset") as pbar:
+            for shard, start, exported in results:
+                pbar.update(len(exported))
+                if shard is None:
+                    continue
+                chunks.setdefault(shard, {})[start] = exported
+                if sum(len(chunk) for chunk in chunks[shard].values()) == shard_sizes[shard]:
+                    shard_chunks = chunks.pop(shard)
+                    task = (folder, shard, [sample for start in sorted(shard_chunks) for sample in shard_chunks[start]],
+                            compress)
+                    if pool is None:
+                        _write_shard_task(task)
+                    else:
+                        writes.append(pool.apply_async(_write_shard_task, (task,)))
+        for write in writes:
+            write.get()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if with_shards:
+        write_index(folder, len(samples), shards, samples_per_shard, compress, SHARD_ARRAYS)
+    logging.info(f"{len(samples)} samples exported in {folder} as {', '.join(formats)}")
@@ -0,0 +1,152 @@
+import json
+import os
+import logging
+from pathlib import Path
+import numpy as np
+from edge_topology import EDGE_ARRAYS
+
+# Layout of a sharded dataset folder:
+#   index.json                      number of samples, shards, arrays and their dtype
+#   shard_00000/<array>.npy         the arrays of all the samples of the shard concatenated along the first axis
+#   shard_00000/<array>_offsets.npy (samples + 1,) start of each sample in <array>.npy
+#   shard_00000/names.npy           name of each sample
+# With compression each shard is instead one shard_00000.npz holding the same arrays.
+
+# Arrays of each sample and their stored dtype
+SHARD_ARRAYS = {"vertices": np.float32, "faces": np.int32, **EDGE_ARRAYS, "displacement": np.float32}
+
+
+def write_shard(folder: Path, shard: int, names: list, buffers: dict, compress: bool = False):
+    """
+    Write the shard number shard of the samples names.
+    Args:
+        folder: pathlib.Path, folder of the dataset
+        shard: int, number of the shard
+        names: list of str, names of the samples
+        buffers: dict, for each array name the list of the arrays of the samples (already in their stored dtype)
+        compress: bool, write a compressed npz instead of a folder of npy
+    """
+    data = {"names": np.array([str(name) for name in names])}
+    for array_name, buffer in buffers.items():
+        data[array_name] = np.concatenate(buffer)
+        data[f"{array_name}_offsets"] = np.concatenate([[0], np.cumsum([len(array) for array in buffer])]).astype(np.int64)
+
+    shard = f"shard_{shard:05d}"
+    if compress:
+        np.savez_compressed(Path(folder) / f"{shard}.npz", **data)
+    else:
+        (Path(folder) / shard).mkdir(exist_ok=True)
+        for array_name, array in data.items():
+            np.save(Path(folder) / shard / f"{array_name}.npy", array)
+    logging.debug(f"{shard} written with {len(names)} samples")
+
+
+def write_index(folder: Path, samples: int, shards: int, samples_per_shard: int, compress: bool, arrays: dict):
+    """
+    Write the index.json of a dataset of samples samples in shards shards, read by ShardedDataset.
+    """
+    index = {"samples": samples, "shards": shards, "samples_per_shard": samples_per_shard, "compress": compress,
+             "arrays": {name: np.dtype(dtype).name for name, dtype in arrays.items()}}
+    with open(Path(folder) / "index.json", "w") as fileout:
+        json.dump(index, fileout, indent=2)
+    logging.info(f"{samples} samples written in {shards} shards in {folder}")
+
+
+class ShardedDataset:
+    """
+    Random access reader of a dataset written with write_shard and write_index (see dataset_export.export_samples).
+    The npy shards are memory-mapped read-only, so sample i is a dict of NumPy views (vertices, faces, edges and
+    edge features, displacement...) obtained in O(1) without copy or parsing, and the processes reading the same dataset
+    (e.g. dataloader workers) share the page cache. The compressed npz shards are loaded in memory instead.
+    The shards are opened lazily by each process: a pickled or forked reader opens its own memory maps.
+    Args:
+        folder: pathlib.Path, folder of the index.json
+        arrays = None list of the arrays to read (default all the arrays of the index)
+    """
+    def __init__(self, folder: Path, arrays: list = None):
+        self.folder = Path(folder)
+        with open(self.folder / "index.json") as filein:
+            self.index = json.load(filein)
+        self.arrays = list(self.index["arrays"]) if arrays is None else list(arrays)
+        self.compress = self.index["compress"]
+
+        # Global index of the first sample of each shard
+        sizes = [len(self._load(shard, "names")) for shard in range(self.index["shards"])]
+        self.starts = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self._shards = {}
+        self._pid = None
+
+    def _path(self, shard: int) -> Path:
+        return self.folder / (f"shard_{shard:05d}.npz" if self.compress else f"shard_{shard:05d}")
+
+    def _load(self, shard: int, name: str) -> np.ndarray:
+        if self.compress:
+            with np.load(self._path(shard)) as data:
+                return data[name]
+        return np.load(self._path(shard) / f"{name}.npy", mmap_mode="r")
+
+    def _shard(self, shard: int) -> dict:
+        """
+        Arrays and offsets of shard, opened once per process.
+        """
+        if self._pid != os.getpid():
+            # Memory maps opened by another process are not reused
+            self._shards = {}
+            self._pid = os.getpid()
+        if shard not in self._shards:
+            if self.compress:
+                with np.load(self._path(shard)) as data:
+                    self._shards[shard] = {name: data[name] for name in data.files}
+            else:
+                names = ["names"] + [name for array in self.arrays for name in (array, f"{array}_offsets")]
+                self._shards[shard] = {name: self._load(shard, name) for name in names}
+        return self._shards[shard]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        state["_pid"] = None
+        return state
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    def locate(self, i: int):
+        """
+        Return the (shard, index in the shard) of the sample i.
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Sample {i} out of range for {len(self)} samples")
+        shard = int(np.searchsorted(self.starts, i, side="right")) - 1
+        return shard, i - int(self.starts[shard])
+
+    def __getitem__(self, i: int) -> dict:
+        shard, j = self.locate(i)
+        data = self._shard(shard)
+        sample = {"name": str(data["names"][j])}
+        for array in self.arrays:
+            offsets = data[f"{array}_offsets"]
+            sample[array] = data[array][offsets[j]:offsets[j + 1]]
+        return sample
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def batches(self, batch_size: int, shuffle: bool = False, seed: int = None, drop_last: bool = False):
+        """
+        Iterate over the dataset by lists of batch_size samples (views, see __getitem__).
+        Args:
+            batch_size: int, number of samples of each batch
+            shuffle = False bool, visit the samples in a random order (the samples of a batch are read shard by shard)
+            seed = None int, seed of the shuffling
+            drop_last = False bool, skip the last batch if it is smaller than batch_size
+        """
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            if drop_last and len(batch) < batch_size:
+                return
+            yield [self[int(i)] for i in (np.sort(batch) if shuffle else batch)]
@@ -0,0 +1,50 @@
+import numpy as np
+
+# Per-edge arrays computed by edge_topology and stored with each sample, with their stored dtype
+EDGE_ARRAYS = {"edges": np.int32, "edge_faces": np.int32, "dihedral_angle": np.float32, "edge_length": np.float32}
+
+
+def edge_topology(vertices: np.ndarray, faces: np.ndarray) -> dict:
+    """
+    Edge topology and geometric features of the surface (vertices, faces), computed once with array operations
+    so the model does not rebuild them at every epoch.
+    The edges are in the order of check_edges_number.unique_edges: sorted (smallest vertex, largest vertex) pairs.
+    Return a dict of:
+        edges: (E, 2) vertex indexes of each edge
+        edge_faces: (E, 2) the two faces sharing each edge, -1 for the missing face of a boundary edge
+        dihedral_angle: (E,) interior angle between the two faces in radian, in (0, 2 pi): pi for flat, below pi
+            for a convex edge, above for a concave one (nan for boundary edges)
+        edge_length: (E,) length of each edge
+    The dihedral angle expects consistently oriented outward faces (see dataset_export.orient_faces).
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    directed_edges = faces[:, [[0, 1], [1, 2], [2, 0]]].reshape(-1, 2)
+    half_edges = np.sort(directed_edges, axis=1)
+    face_of = np.repeat(np.arange(len(faces)), 3)
+
+    vertices_number = faces.max() + 1
+    keys, edge_of = np.unique(half_edges[:, 0] * vertices_number + half_edges[:, 1], return_inverse=True)
+    edges = np.column_stack([keys // vertices_number, keys % vertices_number])
+
+    # The half-edges grouped by edge give the faces of each edge
+    order = np.argsort(edge_of, kind="stable")
+    counts = np.bincount(edge_of, minlength=len(edges))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    edge_faces = np.full((len(edges), 2), -1, dtype=np.int64)
+    edge_faces[:, 0] = face_of[order[starts]]
+    shared = counts > 1
+    edge_faces[shared, 1] = face_of[order[starts[shared] + 1]]
+
+    triangles = vertices[faces]
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), np.finfo(np.float64).tiny)
+    normals_0, normals_1 = normals[edge_faces[:, 0]], normals[edge_faces[:, 1]]
+    bending = np.arccos(np.clip(np.einsum("ij,ij->i", normals_0, normals_1), -1.0, 1.0))
+    # The edge is convex when the normals turn around it in the direction face 0 goes along it
+    direction = np.diff(vertices[directed_edges[order[starts]]], axis=1)[:, 0]
+    convex = np.einsum("ij,ij->i", np.cross(normals_0, normals_1), direction) >= 0
+    dihedral_angle = np.where(shared, np.where(convex, np.pi - bending, np.pi + bending), np.nan)
+
+    edge_length = np.linalg.norm(vertices[edges[:, 1]] - vertices[edges[:, 0]], axis=1)
+    return {"edges": edges, "edge_faces": edge_faces, "dihedral_angle": dihedral_angle, "edge_length": edge_length}
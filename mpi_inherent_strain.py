@@ -0,0 +1,49 @@
+import argparse
+import logging
+from pathlib import Path
+from dolfin import MPI
+from InherentStrain import InherentStrainSession
+from stl_to_msh import mesh_surface, mesh_counts
+from check_edges_number import read_stl_triangles, weld_triangles
+
+# Simulate large parts with one InherentStrainSession distributed over the MPI ranks.
+# Strong scaling on one machine:
+#   for n in 1 2 4 8; do mpirun -n $n python mpi_inherent_strain.py part.msh -o results --backend cg_amg; done
+# every run adds a line "ranks input dof setup_time solve_time" to results/scaling.txt
+
+parser = argparse.ArgumentParser(description="Inherent strain simulation of large parts under mpirun")
+parser.add_argument("inputs", type=Path, nargs="+", help="msh files, or stl files meshed by rank 0")
+parser.add_argument("-o", "--output_folder", type=Path, default=Path("results"))
+parser.add_argument("--backend", default="cg_amg", choices=["lu", "cg_amg"])
+parser.add_argument("--tetra_target", type=int, default=None, help="number of tetrahedra of the stl inputs")
+parser.add_argument("--repeat", type=int, default=2,
+                    help="solves of each input, the first one pays the forms compilation and is not reported")
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    comm = MPI.comm_world
+    rank = MPI.rank(comm)
+    if rank == 0:
+        args.output_folder.mkdir(parents=True, exist_ok=True)
+    MPI.barrier(comm)
+
+    session = InherentStrainSession(k=5.0, z_clamping_tolerance=0.1, backend=args.backend)
+    for input in args.inputs:
+        points = tetra = None
+        if input.suffix == ".stl" and rank == 0:
+            points, tetra = mesh_surface(*weld_triangles(read_stl_triangles(input)), tetra_target=args.tetra_target)
+            logging.info(f"{input} meshed: {mesh_counts(tetra, len(points))}")
+
+        # The output files are written only once, by the last solve
+        results = [session.solve(input, args.output_folder, points, tetra, write_files=repeat == args.repeat - 1)
+                   for repeat in range(args.repeat)]
+        result = results[-1]
+        if rank == 0:
+            logging.info(f"{input}: {result['ranks']} ranks, {result['dof']} dof, "
+                         f"setup {result['setup_time']:.2f}s, solve {result['solve_time']:.2f}s")
+            with open(args.output_folder / "scaling.txt", "a") as fileout:
+                fileout.write(f"{result['ranks']} {input.name} {result['dof']} "
+                              f"{result['setup_time']:.4f} {result['solve_time']:.4f}\n")
@@ -1,21 +1,24 @@
 import logging
 from tqdm import tqdm
 from pathlib import Path
-from InherentStrain import InherentStrain
+from InherentStrain import solve_many
+from stl_to_msh import mesh_stl_files, write_mesh_counts, MeshParameters, MESH_TIMEOUT, MESH_MAX_RSS
+from dataset_export import export_samples
 from cubes_generator import generate_polygon
-from check_edges_number import remove_not_exact
-from vtk_extract_correction import extraction_correction
 import os
-import pyvista as pv
 import numpy as np
-import trimesh 
 
 logger_path = "Logs.log"
 logging.basicConfig(format='%(asctime)s - %(message)s', filename=logger_path, level=logging.DEBUG)
 
 def generate_dataset(dataset_path: Path, final_path: Path, number_sample: int = 100,
                     max_edge_size: float = 2.0, noise: float = 0.001, edges_target: int = 3000,
-                    number_of_vert: int = 2000, gmsh_path: str = r"gmsh-3.0.6-Linux64/bin/gmsh" ):
+                    number_of_vert: int = 2000, gmsh_path: str = r"gmsh-3.0.6-Linux64/bin/gmsh", workers: int = 1,
+                    in_memory_mesh: bool = False,
+                    tetra_target: int = None, dof_target: int = None, solver_backend: str = "lu", strains: list = None,
+                    threads_per_worker: int = 1, debug_files: bool = False, formats: tuple = ("shards",),
+                    binary_stl: bool = True, compress: bool = False, samples_per_shard: int = 1000,
+                    mesh_timeout: float = MESH_TIMEOUT, mesh_max_rss: float = MESH_MAX_RSS ):
     """
     Generate the dataset for AM simulation.
     Args:
@@ -27,6 +30,22 @@ def generate_dataset(dataset_path: Path, final_path: Path, number_sample: int =
         - edges_target: number of edges to have per file
         - number_of_vert defimation target
         - gmsh_path: Where is gmsh 3.0.6
+        - workers: number of processes used to generate, mesh and simulate the shapes
+        - in_memory_mesh: mesh each stl with gmsh just before its simulation and give the tetra arrays to the solver, no msh file is written
+            (mesh_max_rss then limits the whole simulation process during the meshing)
+        - tetra_target: if given, the mesh size of each part is picked from its volume to have about this number of tetrahedra
+        - dof_target: if given, the mesh size of each part is picked from its volume to have about this number of P2 dofs
+        The achieved tetra, nodes and dof numbers and the simulation times of each part are written in final_path/mesh_counts.csv
+        - mesh_timeout: wall-clock time (s) allowed to mesh one part, above it the part is killed and reported (None for no limit)
+        - mesh_max_rss: memory (MiB) allowed to a meshing process, above it the part is killed and reported (None for no limit)
+        - solver_backend: linear solver of the simulation, "lu", "cholmod" or "cg_amg" (see InherentStrainSession)
+        - strains: list of (3, 3) inherent strain tensors or functions of z, each part is simulated with all of them (one sample per load case)
+        - threads_per_worker: number of BLAS and OpenMP threads of each simulation process
+        - debug_files: also write the pvd/vtu files of the simulations (boundary marker, inherent strain, displacement) in dataset_path
+        - formats: exported formats, "shards" (binary shards, see dataset_shards) and/or the per-sample files "vtk", "stl", "obj", "txt"
+        - binary_stl: write the stl files in binary (ascii if False)
+        - compress: write compressed npz shards
+        - samples_per_shard: number of samples of each shard
 
     """
     # Create the dataset folder if it do not exist
@@ -34,21 +53,42 @@ def generate_dataset(dataset_path: Path, final_path: Path, number_sample: int =
     final_path.mkdir(parents=True, exist_ok=True)
 
     # Generate the cubes obj files
-    generate_polygon(path = dataset_path, number_sample = number_sample, noise=noise, number_of_vert= number_of_vert, max_edge_size = max_edge_size)
-
-    # Remove files with the wrong number of edges:
-    remove_not_exact(folder_path= dataset_path, edges_target=edges_target )
-    # Generate the msh file of each obj
-    os.system(f"python3 stl_to_msh.py --path_stl {dataset_path}")
-
-    # Generate the simulation of each msh
-    msh_files = dataset_path.glob("*.msh")
-    msh_files = list(msh_files)
-    logging.info(f"Start computing the deformation, {len(msh_files)} files found")
-    pbar = tqdm(msh_files)
-    for msh in pbar:
-        pbar.set_description("Computing deformation files")
-        InherentStrain(input= msh, output_folder= dataset_path, k = 1.0e8, z_clamping_tolerance = 0.1)
+    generate_polygon(path = dataset_path, number_sample = number_sample, noise=noise, number_of_vert= number_of_vert, max_edge_size = max_edge_size, workers = workers, edges_target = edges_target)
+
+    # The files with the wrong number of edges are rejected during the generation and never written
+    # Each simulation process keeps one solver session, the forms are compiled and the solver configured once
+    session_kwargs = {"k": 5.0, "z_clamping_tolerance": 0.1, "backend": solver_backend}
+    if in_memory_mesh:
+        # The stl are meshed in memory by the simulation processes, no msh file is written
+        stl_files = sorted(dataset_path.glob("*.stl"))
+        logging.info(f"Start meshing and computing the deformation, {len(stl_files)} files found")
+        results = solve_many(stl_files, dataset_path, workers = workers, threads_per_worker = threads_per_worker, strains = strains,
+                             mesh_kwargs = {"parameters": MeshParameters(), "tetra_target": tetra_target,
+                                            "dof_target": dof_target, "timeout": mesh_timeout, "max_rss": mesh_max_rss},
+                             write_files = debug_files, return_surface = True, original_surface = True, **session_kwargs)
+    else:
+        # Generate the msh file of each stl
+        mesh_results = mesh_stl_files(sorted(dataset_path.glob("*.stl")), MeshParameters(), workers=workers,
+                                      timeout=mesh_timeout, max_rss=mesh_max_rss, tetra_target=tetra_target,
+                                      dof_target=dof_target)
+
+        # Generate the simulation of each msh
+        msh_files = [result["msh"] for result in mesh_results if result["status"] == "ok"]
+        if msh_files:
+            logging.info(f"Meshes: {np.mean([r['tetra'] for r in mesh_results if r['status'] == 'ok']):.0f} tetra and "
+                         f"{np.mean([r['dof'] for r in mesh_results if r['status'] == 'ok']):.0f} P2 dofs on average")
+        logging.info(f"Start computing the deformation, {len(msh_files)} files found")
+        results = solve_many(msh_files, dataset_path, workers = workers, threads_per_worker = threads_per_worker, strains = strains,
+                             write_files = debug_files, return_surface = True, original_surface = True, **session_kwargs)
+
+    # Achieved mesh size and simulation cost of each part, to tune tetra_target / dof_target
+    counts = [{"name": input.stem, "status": "ok" if result is not None else "error",
+               **({column: result[column] for column in ("tetra", "nodes", "dof", "setup_time", "solve_time")}
+                  if result is not None else {})}
+              for input, result in results]
+    if not in_memory_mesh:
+        counts += [{"name": r["stl"].stem, "status": r["status"]} for r in mesh_results if r["status"] != "ok"]
+    write_mesh_counts(final_path / "mesh_counts.csv", counts)
 
     # Transfert the simulation results and mesh to the final_path folder
     # Copy the logs as there is the generation option
@@ -56,27 +96,15 @@ def generate_dataset(dataset_path: Path, final_path: Path, number_sample: int =
     dest = final_path / Path(logger_path).name
     dest.write_bytes(src.read_bytes())
 
-    vtu_files = dataset_path.glob("*_Displacement000000.vtu")
-    vtu_files = list(vtu_files)
+    # The surface and the displacement of its vertices are returned by the simulations, no vtu file is read.
+    # The surface is the generated obj one and the labels follow its vertex order
+    samples = [(name, result["vertices"], result["faces"], displacement)
+               for _, result in results if result is not None
+               for name, displacement in zip(result["names"], result["displacement"])]
 
-    logging.info(f"Start exporting the results to the final folder, {len(vtu_files)} files found")
-    pbar = tqdm(vtu_files)
-    for vtu in pbar:
-        pbar.set_description("Creating the final dataset")
-
-        unstructured_mesh = pv.read(vtu)
-        mesh = unstructured_mesh.extract_surface()
-
-        # Save the mesh
-        mesh.save(final_path / Path(vtu.name.split("._")[0]).with_suffix(".vtk"))
-        mesh.save(final_path / Path(vtu.name.split("._")[0]).with_suffix(".stl"), binary=False)
-    
-        # Save the displacement label
-        np.savetxt( final_path / Path(vtu.name.split("._")[0]).with_suffix(".txt") , mesh.point_data["displacement"])
-
-        # Load and the mesh in obj
-        mesh = trimesh.load(final_path / Path(vtu.name.split("._")[0]).with_suffix(".stl"), process= True)
-        mesh.export(final_path / Path(vtu.name.split("._")[0]).with_suffix(".obj"))
+    logging.info(f"Start exporting the results to the final folder, {len(samples)} samples found")
+    export_samples(samples, final_path, formats = formats, workers = workers, binary_stl = binary_stl,
+                   compress = compress, samples_per_shard = samples_per_shard)
 
 
 if __name__ == "__main__":
@@ -98,11 +126,9 @@ if __name__ == "__main__":
         number_of_vert = 2000
         edges_target = 3000
         gmsh_path = r"gmsh-3.0.6-Linux64/bin/gmsh"
+        workers = os.cpu_count()
 
         logging.info(f"Start generating dataset")
-        logging.info(f"Phase {phase} parameters: \n\tnumber_sample:{number_sample} \n\tnoise:{noise} \n\tnumber_of_vert:{number_of_vert} \n\tedges_target:{edges_target} \n\tmax_edge_size:{max_edge_size}")
-        generate_dataset(dataset_path, final_path, number_sample,max_edge_size, noise,edges_target, number_of_vert,gmsh_path)
-
-        logging.info(f"Start correcting the dataset")
-        extraction_correction(final_path)
+        logging.info(f"Phase {phase} parameters: \n\tnumber_sample:{number_sample} \n\tnoise:{noise} \n\tnumber_of_vert:{number_of_vert} \n\tedges_target:{edges_target} \n\tmax_edge_size:{max_edge_size} \n\tworkers:{workers}")
+        generate_dataset(dataset_path, final_path, number_sample,max_edge_size, noise,edges_target, number_of_vert,gmsh_path, workers)
 
@@ -0,0 +1,93 @@
+import logging
+import random
+import time
+from pathlib import Path
+import numpy as np
+from dolfin import MPI
+from InherentStrain import InherentStrainSession, mesh_from_arrays, distributed_mesh
+from cubes_generator import box_surface
+from stl_to_msh import mesh_surface, MeshParameters
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+def benchmark(output_folder: Path, backends: tuple = ("lu", "cholmod", "cg_amg"), number_parts: int = 5, edges_target: int = 3000,
+              height_max: float = 30, height_min: float = 10, seed: int = 0) -> dict:
+    """
+    Compare the solver backends of InherentStrainSession on the same random P2 box meshes.
+    Args:
+        output_folder: pathlib.Path, where to save the output files
+        backends: tuple of the InherentStrainSession backends to compare
+        number_parts: int, how many boxes are solved by each backend
+        edges_target: int, number of edges of the box surfaces
+        height_max: float = 30 Maximum size of the boxes
+        height_min: float = 10 Minimum size of the boxes
+        seed: int, seed of the box dimensions
+    The output files are not written, so only the setup and the solve are timed.
+    Return for each backend the mean setup and solve time, the solve time of a mesh solved again right after itself
+    (same sparsity pattern, CHOLMOD reuses its symbolic analysis) and the largest relative residual.
+    """
+    output_folder.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    meshes = []
+    for i in range(number_parts):
+        box = box_surface([rng.uniform(height_min, height_max) for _ in range(3)], edges_target)
+        vertices = box.vertices - [0, 0, box.vertices[:, 2].min()]
+        meshes.append(mesh_surface(vertices, box.faces, MeshParameters()))
+
+    timings = {}
+    for backend in backends:
+        session = InherentStrainSession(backend=backend)
+        results = [session.solve(Path(f"{backend}_{i}.msh"), output_folder, points=points, tetra=tetra, write_files=False)
+                   for i, (points, tetra) in enumerate(meshes)]
+        # The last mesh again, with the same sparsity pattern as the previous solve
+        points, tetra = meshes[-1]
+        repeated = session.solve(Path(f"{backend}_repeat.msh"), output_folder, points=points, tetra=tetra, write_files=False)
+        # The first solve pays the forms compilation
+        timings[backend] = {"setup_time": np.mean([r["setup_time"] for r in results[1:] or results]),
+                            "solve_time": np.mean([r["solve_time"] for r in results[1:] or results]),
+                            "repeat_solve_time": repeated["solve_time"],
+                            "residual": max(max(r["residual"]) for r in results + [repeated])}
+        logging.info(f"{backend}: setup {timings[backend]['setup_time']:.3f}s, solve {timings[backend]['solve_time']:.3f}s, "
+                     f"same mesh solve {timings[backend]['repeat_solve_time']:.3f}s, residual {timings[backend]['residual']:.2e}")
+    return timings
+
+
+def loader_benchmark(output_folder: Path, tetra_targets: tuple = (10000, 100000, 1000000), size: float = 20) -> list:
+    """
+    Compare the two ways of building the dolfin Mesh of a tetra mesh given as arrays: mesh_from_arrays (MeshEditor
+    filled in C++) and the xdmf/h5 round trip (meshio write then XDMFFile read, see distributed_mesh).
+    Args:
+        output_folder: pathlib.Path, where the xdmf files are written
+        tetra_targets: tuple of the number of tetrahedra of the box meshes
+        size: float, size of the cubes
+    Return for each mesh its number of tetrahedra and the time of each loader.
+    """
+    output_folder.mkdir(parents=True, exist_ok=True)
+    box = box_surface([size] * 3, 3000)
+    # The first call compiles the MeshEditor code
+    points, tetra = mesh_surface(box.vertices, box.faces, MeshParameters())
+    mesh_from_arrays(points, tetra)
+
+    timings = []
+    for tetra_target in tetra_targets:
+        points, tetra = mesh_surface(box.vertices, box.faces, MeshParameters(), tetra_target=tetra_target)
+        start = time.perf_counter()
+        arrays_mesh = mesh_from_arrays(points, tetra)
+        arrays_time = time.perf_counter() - start
+        start = time.perf_counter()
+        xdmf_mesh = distributed_mesh(points, tetra, output_folder / f"loader_{tetra_target}.xdmf", MPI.comm_self)
+        xdmf_time = time.perf_counter() - start
+        assert arrays_mesh.num_cells() == xdmf_mesh.num_cells() == len(tetra)
+        timings.append({"tetra": len(tetra), "arrays_time": arrays_time, "xdmf_time": xdmf_time})
+        logging.info(f"{len(tetra)} tetrahedra: arrays {arrays_time:.3f}s, xdmf {xdmf_time:.3f}s")
+    return timings
+
+
+if __name__ == "__main__":
+    timings = benchmark(Path("benchmark"))
+    for backend, timing in timings.items():
+        print(f"{backend:>10}: setup {timing['setup_time']:.3f}s  solve {timing['solve_time']:.3f}s  "
+              f"same mesh solve {timing['repeat_solve_time']:.3f}s  residual {timing['residual']:.2e}")
+    for timing in loader_benchmark(Path("benchmark")):
+        print(f"{timing['tetra']:>10} tetrahedra: mesh_from_arrays {timing['arrays_time']:.3f}s  "
+              f"xdmf round trip {timing['xdmf_time']:.3f}s")
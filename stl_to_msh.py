@@ -11,44 +11,117 @@
 Import the libraries
 '''
 
+import contextlib
+import copy
 import datetime
 import pathlib
 import time
 import multiprocessing as mp
 import os
+import signal
+import threading
 import gmsh
+import numpy as np
+import psutil
+from tqdm import tqdm
+from check_edges_number import read_stl_triangles, weld_triangles
 
 
 import argparse
 
+# Default limits of the meshing of one file: wall-clock time (s) and memory of the process (MiB)
+MESH_TIMEOUT = 600.0
+MESH_MAX_RSS = 4096.0
+
 parser = argparse.ArgumentParser(description='Process stl files to msh files.')
 parser.add_argument("-p" , '--path_stl', metavar='P', type=str, nargs='+',
                     help='Where are stored the stl files')
-args = parser.parse_args()
+parser.add_argument("-w", "--workers", type=int, default=mp.cpu_count(),
+                    help='Number of meshing processes')
+parser.add_argument("--maxtasksperchild", type=int, default=8,
+                    help='Number of files meshed by a process before it is replaced (contains the gmsh memory leak)')
+parser.add_argument("--timeout", type=float, default=MESH_TIMEOUT,
+                    help='Wall-clock time (s) allowed to mesh one file, the file is killed and reported above it')
+parser.add_argument("--max_rss", type=float, default=MESH_MAX_RSS,
+                    help='Memory (MiB) allowed to a meshing process, the file is killed and reported above it')
 '''
 Mesh Parameters
 '''
 
 
+# Volume of a regular tetrahedron with unit edges, used to size the mesh from a tetra budget
+REGULAR_TETRA_VOLUME = 1 / (6 * 2**0.5)
+# Average number of P2 vector dofs per tetrahedron (3 * (nodes + edges) ~ 4.1 * tetra for Delaunay meshes)
+P2_DOF_PER_TETRA = 4.1
+
 # we have a class where the parameters are
 
 class MeshParameters:
-    def __init__(option, Algorithm3D, MinLength, MaxLength, OptimizationNet,
-                 Quality, Version, Iteration, AngleTol):
+    def __init__(option, Algorithm3D=1, MinLength=0.01, MaxLength=15.00, OptimizationNet=0,
+                 Quality=2, Version=2.2, Iteration=2155000, AngleTol=0.05):
         # kind of mesh, 1 for Delaunay meshes
-        option.Algorithm3D = gmsh.option.setNumber("Mesh.Algorithm3D", Algorithm3D)
-        option.MinLength = gmsh.option.setNumber("Mesh.CharacteristicLengthMin", MinLength)
-        option.MaxLength = gmsh.option.setNumber("Mesh.CharacteristicLengthMax", MaxLength)
+        option.Algorithm3D = Algorithm3D
+        option.MinLength = MinLength
+        option.MaxLength = MaxLength
         # Optimize the mesh using Netgen to improve the quality of tetrahedral elements
-        option.OptimizationNet = gmsh.option.setNumber("Mesh.OptimizeNetgen", OptimizationNet)
+        option.OptimizationNet = OptimizationNet
         # type of quality 2: gamma~vol/sum_face/max_edge
-        option.Quality = gmsh.option.setNumber("Mesh.QualityType", Quality)
+        option.Quality = Quality
         # version of mesh file, use 2.2
-        option.Version = gmsh.option.setNumber("Mesh.MshFileVersion", Version)
+        option.Version = Version
         # Maximum number of point insertion iterations in 3D Delaunay
-        option.Iteration = gmsh.option.setNumber("Mesh.MaxIterDelaunay3D", Iteration)
+        option.Iteration = Iteration
         # Consider connected facets as overlapping
-        option.AngleTol = gmsh.option.setNumber("Mesh.AngleToleranceFacetOverlap", AngleTol)
+        option.AngleTol = AngleTol
+
+    def apply(option):
+        # set the parameters in gmsh, which must be initialized
+        gmsh.option.setNumber("Mesh.Algorithm3D", option.Algorithm3D)
+        gmsh.option.setNumber("Mesh.CharacteristicLengthMin", option.MinLength)
+        gmsh.option.setNumber("Mesh.CharacteristicLengthMax", option.MaxLength)
+        gmsh.option.setNumber("Mesh.OptimizeNetgen", option.OptimizationNet)
+        gmsh.option.setNumber("Mesh.QualityType", option.Quality)
+        gmsh.option.setNumber("Mesh.MshFileVersion", option.Version)
+        gmsh.option.setNumber("Mesh.MaxIterDelaunay3D", option.Iteration)
+        gmsh.option.setNumber("Mesh.AngleToleranceFacetOverlap", option.AngleTol)
+
+    def sized(option, volume, tetra_target=None, dof_target=None):
+        # copy of the parameters with the characteristic length picked from the part volume
+        # so the mesh has about tetra_target tetrahedra (or dof_target P2 vector dofs)
+        if tetra_target is None:
+            tetra_target = dof_target / P2_DOF_PER_TETRA
+        length = (volume / (tetra_target * REGULAR_TETRA_VOLUME)) ** (1 / 3)
+        sized = copy.copy(option)
+        sized.MaxLength = length
+        sized.MinLength = min(option.MinLength, length)
+        return sized
+
+
+def surface_volume(vertices, faces):
+    # volume enclosed by a closed and consistently oriented triangulated surface
+    v0, v1, v2 = (np.asarray(vertices, dtype=np.float64)[np.asarray(faces)[:, i]] for i in range(3))
+    return abs(np.einsum("ij,ij->i", v0, np.cross(v1, v2)).sum()) / 6
+
+
+def mesh_counts(tetra, nodes_number):
+    # achieved size of a tetra mesh: number of tetrahedra, nodes and P2 vector dofs (3 * (nodes + edges))
+    tetra = np.asarray(tetra, dtype=np.int64).reshape(-1, 4)
+    edges = np.sort(np.stack([tetra[:, [0, 0, 0, 1, 1, 2]], tetra[:, [1, 2, 3, 2, 3, 3]]], axis=-1).reshape(-1, 2), axis=1)
+    edges_number = np.unique(edges[:, 0] * nodes_number + edges[:, 1]).shape[0]
+    return {"tetra": len(tetra), "nodes": nodes_number, "dof": 3 * (nodes_number + edges_number)}
+
+
+# Columns of the csv written by write_mesh_counts
+MESH_COUNTS_COLUMNS = ("name", "status", "tetra", "nodes", "dof", "setup_time", "solve_time")
+
+
+def write_mesh_counts(csv_path, rows):
+    # Write the achieved mesh size (and simulation cost) of each part, rows are dicts with MESH_COUNTS_COLUMNS keys,
+    # the missing ones are left empty
+    with open(csv_path, "w") as fileout:
+        fileout.write(",".join(MESH_COUNTS_COLUMNS) + "\n")
+        for row in rows:
+            fileout.write(",".join("" if row.get(column) is None else str(row[column]) for column in MESH_COUNTS_COLUMNS) + "\n")
 
 
 '''
@@ -74,23 +147,19 @@ the_lock = mp.Lock()
 
 
 
-def mesher(the_stl ):
-    # --PATH-- #
-    folder = args.path_stl[0]
-    if folder[-1] != "/":
-        folder = folder + "/"
-    # Put your own path:
-    folder_stl = folder
-    folder_msh = folder
-    folder_report = folder + "report.txt"
+def mesher(the_stl, folder_msh, folder_report, parameters=None, tetra_target=None, dof_target=None):
+    # Mesh the_stl (pathlib.Path) into folder_msh/<name>.msh, the problems are written in folder_report.
+    # If tetra_target or dof_target is given, the parameters are sized from the volume of the part.
+    # Return the result of the file: {"stl", "msh", "status", "problem", "time", "tetra", "nodes", "dof"}
 
     # --MANAGEMENT-- #
 
-    # we # print the CPU working on the stl
-    # print('The', the_stl, 'is on', mp.current_process())
-    # Manage the name
-    x = the_stl.split('.')
-    file_name = x[0]
+    the_stl = pathlib.Path(the_stl)
+    msh_path = pathlib.Path(folder_msh) / (the_stl.name.split('.')[0] + '.msh')
+    if parameters is None:
+        parameters = MeshParameters()
+    start = time.perf_counter()
+    counts = {"tetra": None, "nodes": None, "dof": None}
 
     # --MESHING-- #
 
@@ -98,20 +167,17 @@ def mesher(the_stl ):
     gmsh.initialize()
     gmsh.clear()
 
-    # we fill the class with parameters
-    MeshParameters(1,  # Algorithm
-                   0.01,  # MinLength
-                   15.00,  # MaxLength
-                   0,  # Optimization Net
-                   2,  # Quality
-                   2.2,  # Version
-                   2155000,  # iteration
-                   0.05)  # angle tolerance
-
+    # we fill gmsh with the parameters
+    parameters.apply()
 
     try:
+        if tetra_target is not None or dof_target is not None:
+            volume = surface_volume(*weld_triangles(read_stl_triangles(the_stl)))
+            parameters = parameters.sized(volume, tetra_target, dof_target)
+            parameters.apply()
+
         # print("Processing", the_stl)
-        gmsh.merge(folder_stl + the_stl)  # we capture the stl file
+        gmsh.merge(str(the_stl))  # we capture the stl file
 
         n = gmsh.model.getDimension()
         s = gmsh.model.getEntities(n)
@@ -124,17 +190,19 @@ def mesher(the_stl ):
         # we generate the mesh here
         gmsh.model.mesh.generate(3)
         # when  the generation is done we write the .msh file
-        gmsh.write(folder_msh + file_name + '.msh')  # we create the .msh file
+        gmsh.write(str(msh_path))  # we create the .msh file
+        counts = mesh_counts(gmsh.model.mesh.getElementsByType(4)[1], len(gmsh.model.mesh.getNodes()[0]))
 
         gmsh.finalize()
 
         # print("Meshing is done")
         # print("")
-
+        return {"stl": the_stl, "msh": msh_path, "status": "ok", "problem": None,
+                "time": time.perf_counter() - start, **counts}
 
     except Exception as exception:
         # print("  _/!\_File", the_stl, 'has a problem. Problem:', exception)
-        report(the_stl, exception, folder_report)
+        report(the_stl.name, exception, folder_report)
 
         gmsh.finalize()
 
@@ -148,75 +216,211 @@ def mesher(the_stl ):
         # gmsh.option.setNumber("Mesh.MeshSizeFromCurvature", 0)
         # mesh_here(folder_msh,fileName)#we generate again
         # print("")
+        return {"stl": the_stl, "msh": None, "status": "error", "problem": str(exception),
+                "time": time.perf_counter() - start, **counts}
+
+
+def mesh_surface(vertices, faces, parameters=None, msh_path=None, tetra_target=None, dof_target=None):
+    """
+    Mesh the volume enclosed by a triangulated surface without going through stl and msh files.
+    The surface is given to gmsh as a discrete entity, as gmsh.merge would do with the stl.
+    Args:
+        vertices: (n, 3) array of the surface vertices
+        faces: (m, 3) array of the surface triangles (indexes in vertices)
+        parameters: MeshParameters (default MeshParameters())
+        msh_path: if given, the msh file is also written there
+        tetra_target: if given, the parameters are sized from the volume to have about this number of tetrahedra
+        dof_target: if given, the parameters are sized from the volume to have about this number of P2 dofs
+    Return (points, tetra): the (N, 3) nodes, which start with the n surface vertices, and the (M, 4) tetrahedra.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    if parameters is None:
+        parameters = MeshParameters()
+    if tetra_target is not None or dof_target is not None:
+        parameters = parameters.sized(surface_volume(vertices, faces), tetra_target, dof_target)
 
-
-def mesher2(the_stl:str, folder_stl:str, folder_msh:str, folder_report:str):
-
-    # --MANAGEMENT-- #
-   
-    # Manage the name
-    x = the_stl.split('.')
-    file_name = x[0]
-
-    # --MESHING-- #
-
-    # print("Starting job at", datetime.datetime.now())
-    # print(0)
     gmsh.initialize()
-    # print(1)
     gmsh.clear()
-    # print(2)
-
-    # we fill the class with parameters
-    MeshParameters(1,  # Algorithm
-                   0.01,  # MinLength
-                   15.00,  # MaxLength
-                   0,  # Optimization Net
-                   2,  # Quality
-                   2.2,  # Version
-                   2155000,  # iteration
-                   0.05)  # angle tolerance
-
-
+    parameters.apply()
     try:
-        # print("Processing", the_stl)
-        gmsh.merge(folder_stl + the_stl)  # we capture the stl file
-
-        n = gmsh.model.getDimension()
-        s = gmsh.model.getEntities(n)
-        surf = gmsh.model.geo.addSurfaceLoop([s[i][1] for i in range(len(s))])
+        surf = gmsh.model.addDiscreteEntity(2)
+        # gmsh tags start at 1, the surface vertex i is the node i + 1
+        gmsh.model.mesh.addNodes(2, surf, np.arange(1, len(vertices) + 1), vertices.ravel())
+        gmsh.model.mesh.addElementsByType(surf, 2, [], (faces + 1).ravel())  # 2: 3-node triangle
 
-        gmsh.model.geo.addVolume([surf])  # Create one volume
-        # print("Volume added")
+        loop = gmsh.model.geo.addSurfaceLoop([surf])
+        gmsh.model.geo.addVolume([loop])  # Create one volume
         gmsh.model.geo.synchronize()
-        # dimen = gmsh.model.getDimension()
-        # we generate the mesh here
         gmsh.model.mesh.generate(3)
-        # when  the generation is done we write the .msh file
-        gmsh.write(folder_msh + file_name + '.msh')  # we create the .msh file
+        if msh_path is not None:
+            gmsh.write(str(msh_path))
 
+        node_tags, coords, _ = gmsh.model.mesh.getNodes()
+        _, tetra_tags = gmsh.model.mesh.getElementsByType(4)  # 4: 4-node tetrahedron
+    finally:
         gmsh.finalize()
 
-        # print("Meshing is done")
-        # print("")
+    order = np.argsort(node_tags)
+    node_tags = np.asarray(node_tags)[order]
+    points = np.asarray(coords).reshape(-1, 3)[order]
+    tetra = np.searchsorted(node_tags, np.asarray(tetra_tags)).reshape(-1, 4)
+    return points, tetra
 
 
-    except Exception as exception:
-        # print("  _/!\_File", the_stl, 'has a problem. Problem:', exception)
-        report(the_stl, exception, folder_report)
+'''
+Watchdog
+'''
 
-        gmsh.finalize()
+# Seconds between two checks of the watchdog
+WATCHDOG_PERIOD = 0.5
+# Seconds the parent waits for the watchdog or for the result of a dead process before reporting the file itself
+KILL_GRACE = 5.0
 
-        # we manage the exception here
-        # if str(exception)== 'Invalid boundary mesh (overlapping facets) on surface 1 surface 1':
-        # gmsh.model.geo.remove([(1,1)]) #we solve the problem
-        # mesh_here(folder_msh,fileName)#we generate again
-        # print("")
+# Queue where the workers report the files killed by their watchdog, set by _init_worker
+_status_queue = None
+
+
+def _init_worker(status_queue):
+    global _status_queue
+    _status_queue = status_queue
+
+
+def _killed_result(the_stl, status, problem, elapsed):
+    return {"stl": the_stl, "msh": None, "status": status, "problem": problem,
+            "time": elapsed, "tetra": None, "nodes": None, "dof": None}
+
+
+def process_alive(pid):
+    # False if the process pid exited, even if its parent did not reap it yet
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def _watchdog(the_stl, timeout, max_rss, done, status_queue):
+    # gmsh runs through ctypes which releases the GIL, so this thread keeps running during the meshing
+    start = time.monotonic()
+    process = psutil.Process()
+    while not done.wait(WATCHDOG_PERIOD):
+        status = None
+        if timeout is not None and time.monotonic() - start > timeout:
+            status, problem = "timeout", f"timeout: meshing killed after {timeout} s"
+        elif max_rss is not None and process.memory_info().rss > max_rss * 2**20:
+            status, problem = "OOM", f"OOM: meshing killed above {max_rss} MiB"
+        if status is not None:
+            # SimpleQueue.put is synchronous, the message is sent before the process exits
+            if status_queue is not None:
+                status_queue.put(_killed_result(the_stl, status, problem, time.monotonic() - start))
+            os._exit(1)
+
+
+@contextlib.contextmanager
+def watchdog(the_stl, timeout=None, max_rss=None, status_queue=None):
+    # Kill the process if the block takes more than timeout s or the process more than max_rss MiB,
+    # the_stl is reported in status_queue before
+    done = threading.Event()
+    threading.Thread(target=_watchdog, args=(the_stl, timeout, max_rss, done, status_queue), daemon=True).start()
+    try:
+        yield
+    finally:
+        done.set()
+
+
+def watched_mesher(the_stl, folder_msh, folder_report, parameters=None, timeout=None, max_rss=None,
+                   tetra_target=None, dof_target=None):
+    # Mesh the_stl, the process is killed if it takes more than timeout s or max_rss MiB
+    if _status_queue is not None:
+        # The parent follows the process of each file, to report the files whose process dies without a word
+        _status_queue.put({"started": the_stl, "pid": os.getpid()})
+    with watchdog(the_stl, timeout, max_rss, _status_queue):
+        return mesher(the_stl, folder_msh, folder_report, parameters, tetra_target, dof_target)
+
+
+def mesh_stl_files(stl_files, parameters=None, folder_msh=None, folder_report=None, workers=mp.cpu_count(),
+                   maxtasksperchild=8, timeout=MESH_TIMEOUT, max_rss=MESH_MAX_RSS, tetra_target=None, dof_target=None):
+    """
+    Mesh stl files into msh files with one pool of gmsh processes.
+    Args:
+        stl_files: list of paths of the stl files to mesh
+        parameters: MeshParameters used for all the files (default MeshParameters())
+        folder_msh: where the msh files are written (default: next to each stl)
+        folder_report: text file where the problems are written (default: report.txt next to the first stl)
+        workers: number of meshing processes
+        maxtasksperchild: number of files meshed by a process before it is replaced (contains the gmsh memory leak)
+        timeout: wall-clock time (s) allowed to mesh one file, None for no limit
+        max_rss: memory (MiB) allowed to a meshing process, None for no limit
+        A file whose process dies without reporting (killed by the system OOM-killer, segfault of gmsh) is reported
+        as "crashed", and a process still running KILL_GRACE s after its timeout is killed by the parent.
+        tetra_target: if given, each file is sized from its volume to have about this number of tetrahedra
+        dof_target: if given, each file is sized from its volume to have about this number of P2 dofs
+    Return the list of the results of the files {"stl", "msh", "status", "problem", "time", "tetra", "nodes", "dof"},
+    with status "ok", "error", "timeout", "OOM" or "crashed", in the order of stl_files.
+    """
+    stl_files = [pathlib.Path(the_stl) for the_stl in stl_files]
+    if len(stl_files) == 0:
+        return []
+    if folder_report is None:
+        folder_report = stl_files[0].parent / "report.txt"
+
+    # One pool for all the files. Each process is replaced after maxtasksperchild files
+    # to do not have memory leak, and the files are taken one by one so a slow mesh do not stall the others
+    status_queue = mp.SimpleQueue()
+    pool = mp.Pool(processes=workers, maxtasksperchild=maxtasksperchild,
+                   initializer=_init_worker, initargs=(status_queue,))
+    pending = {the_stl: pool.apply_async(watched_mesher,
+                                         (the_stl, the_stl.parent if folder_msh is None else folder_msh,
+                                          folder_report, parameters, timeout, max_rss, tetra_target, dof_target))
+               for the_stl in stl_files}
+    results = {}
+    started = {}  # (pid, start time) of the files being meshed
+    dead = {}  # time the process of a file was found dead, its result may still be on its way
+
+    with tqdm(total=len(stl_files), desc="Meshing stl files") as pbar:
+        while pending:
+            # The files killed by their watchdog are written in the report
+            while not status_queue.empty():
+                message = status_queue.get()
+                if "started" in message:
+                    started[message["started"]] = (message["pid"], time.monotonic())
+                    continue
+                report(message["stl"].name, message["problem"], folder_report)
+                if pending.pop(message["stl"], None) is not None:
+                    results[message["stl"]] = message
+                    pbar.update()
+            for the_stl in [s for s, async_result in pending.items() if async_result.ready()]:
+                results[the_stl] = pending.pop(the_stl).get()
+                pbar.update()
+
+            # The processes which died or hang without their watchdog reporting them
+            now = time.monotonic()
+            for the_stl in [s for s in pending if s in started]:
+                pid, start = started[the_stl]
+                if timeout is not None and now - start > timeout + KILL_GRACE:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    result = _killed_result(the_stl, "timeout", f"timeout: meshing killed after {timeout} s", now - start)
+                elif not process_alive(pid):
+                    if now - dead.setdefault(the_stl, now) < KILL_GRACE:
+                        continue
+                    result = _killed_result(the_stl, "crashed", f"crashed: meshing process {pid} died (segfault or killed by the system)",
+                                            now - start)
+                else:
+                    continue
+                report(the_stl.name, result["problem"], folder_report)
+                results[the_stl] = result
+                pending.pop(the_stl)
+                pbar.update()
+            time.sleep(WATCHDOG_PERIOD)
+
+    # The tasks of the killed processes stay in the pool cache, so close() would wait for them forever
+    pool.terminate()
+    pool.join()
+    return [results[the_stl] for the_stl in stl_files]
 
-        # if str(exception) == 'PLC Error:  A segment and a facet intersect at point':
-        # gmsh.option.setNumber("Mesh.MeshSizeFromCurvature", 0)
-        # mesh_here(folder_msh,fileName)#we generate again
-        # # print("")
 
 '''
 Check function
@@ -243,12 +447,11 @@ MAIN
 
 
 if __name__ == '__main__':
-    # --PATH-- #
+    args = parser.parse_args()
 
-    path_stl = args.path_stl[0]
+    # --PATH-- #
 
-    if path_stl[-1] != "/":     
-        path_stl = path_stl + "/"
+    path_stl = pathlib.Path(args.path_stl[0])
 
     # --CHECK-- #
 
@@ -260,41 +463,12 @@ if __name__ == '__main__':
     # print('Number of CPUs available:', mp.cpu_count())
 
     # Put inside a list the stl that have to be meshed
-    big_list = [] # all the stl here
-    small_list = [] # just a small number of stl to do not have memory leak
-    with os.scandir(path_stl) as entries:
-
-        for f in entries:
-            if f.name.split('.')[1] == 'stl':
-                big_list.append(str(f.name))
-
-        big_size = len(big_list)
-        # print(big_size)
-
-        while len(big_list) != 0:
-            element = 8
-            # here the collect some element from the big list
-            small_list = big_list[:element]
-            del big_list[:element]
-            # print("")
-            # print('----THE SMALL given to the mp :', small_list)
-            # print("")
-
-            # --MESH WITH MULTIPROCESSING-- #
-            pool = mp.Pool(processes=8)  # define number of cpus
-            pool.map(mesher, small_list)
-
-            #for i in range(len(small_list)):
-            #    os.remove(path_stl+'/'+small_list[i])
-
-            # --MANAGE LIST FOR MP-- #
-
-            del small_list[:element]
-            pool.close()
-            pool.join()
-            pool.terminate()
-            # print('When terminate, big:', len(big_list), ' small', len(small_list))
-            time.sleep(3)
+    big_list = sorted(path_stl.glob("*.stl")) # all the stl here
+
+    # --MESH WITH MULTIPROCESSING-- #
+    # The files going over the timeout or the memory limit are killed and written in report.txt
+    mesh_stl_files(big_list, MeshParameters(), folder_report=path_stl / "report.txt", workers=args.workers,
+                   maxtasksperchild=args.maxtasksperchild, timeout=args.timeout, max_rss=args.max_rss)
 
     later_time = datetime.datetime.now()
     # print("")
@@ -0,0 +1,23 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from cubes_generator import box_surface
+from check_edges_number import unique_edges
+
+
+@pytest.mark.parametrize("edges_target", [18, 21, 3000, 3003])
+@pytest.mark.parametrize("extents", [(1, 1, 1), (10, 20, 30), (30, 10, 10.5)])
+def test_box_surface_has_the_exact_edge_count(extents, edges_target):
+    box = box_surface(extents, edges_target)
+    assert len(unique_edges(box.faces)) == edges_target
+    assert box.is_watertight and box.is_winding_consistent
+    assert np.isclose(box.volume, np.prod(extents))
+
+
+@pytest.mark.parametrize("edges_target", [0, 15, 3001])
+def test_box_surface_rejects_impossible_edge_counts(edges_target):
+    with pytest.raises(ValueError):
+        box_surface((1, 1, 1), edges_target)
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+import numpy as np
+import trimesh
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from dataset_export import orient_faces
+from cubes_generator import box_surface
+
+
+def flip_randomly(faces, seed):
+    flip = np.random.default_rng(seed).random(len(faces)) < 0.5
+    faces = np.array(faces)
+    faces[flip] = faces[flip][:, ::-1]
+    return faces
+
+
+def two_shells():
+    # Two separate spheres, the second one wound inward
+    sphere = trimesh.creation.icosphere(2)
+    vertices = np.vstack([sphere.vertices, sphere.vertices + [5, 0, 0]])
+    faces = np.vstack([sphere.faces, sphere.faces[:, ::-1] + len(sphere.vertices)])
+    return vertices, faces, np.vstack([sphere.faces, sphere.faces + len(sphere.vertices)])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_orient_faces_restores_the_outward_winding(seed):
+    for mesh in [trimesh.creation.icosphere(3), box_surface((3, 5, 7), 3003)]:
+        faces = orient_faces(mesh.vertices, flip_randomly(mesh.faces, seed))
+        # Each face is kept, in the winding of the outward mesh
+        assert np.array_equal(np.sort(faces, axis=1), np.sort(mesh.faces, axis=1))
+        assert np.allclose(trimesh.Trimesh(mesh.vertices, faces, process=False).face_normals, mesh.face_normals)
+
+
+def test_orient_faces_orients_each_shell():
+    vertices, faces, outward = two_shells()
+    faces = orient_faces(vertices, flip_randomly(faces, 0))
+    for shell in np.split(np.arange(len(faces)), 2):
+        mesh = trimesh.Trimesh(vertices, faces[shell], process=False)
+        assert mesh.is_winding_consistent and mesh.volume > 0
+    assert np.allclose(trimesh.Trimesh(vertices, faces, process=False).face_normals,
+                       trimesh.Trimesh(vertices, outward, process=False).face_normals)
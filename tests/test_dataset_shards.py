@@ -0,0 +1,61 @@
+import sys
+import pickle
+from pathlib import Path
+import numpy as np
+import trimesh
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from dataset_export import export_samples
+from dataset_shards import ShardedDataset, SHARD_ARRAYS
+
+
+def make_samples(number):
+    samples = []
+    for i in range(number):
+        sphere = trimesh.creation.icosphere(i % 3)
+        vertices = sphere.vertices * (i + 1)
+        samples.append((f"sample_{i}", vertices, sphere.faces, vertices * 0.01))
+    return samples
+
+
+def check_sample(sample, expected):
+    name, vertices, faces, displacement = expected
+    assert sample["name"] == name
+    assert np.allclose(sample["vertices"], vertices.astype(np.float32))
+    assert np.array_equal(np.sort(sample["faces"], axis=1), np.sort(faces, axis=1))
+    assert np.allclose(sample["displacement"], displacement.astype(np.float32))
+    assert len(sample["edges"]) == len(sample["dihedral_angle"]) == 3 * len(faces) // 2
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip_over_several_shards(tmp_path, compress):
+    samples = make_samples(11)
+    export_samples(samples, tmp_path, compress=compress, samples_per_shard=4, chunksize=3)
+    dataset = ShardedDataset(tmp_path)
+    assert len(dataset) == len(samples) and dataset.index["shards"] == 3
+    assert set(dataset.arrays) == set(SHARD_ARRAYS)
+    for sample, expected in zip(dataset, samples):
+        check_sample(sample, expected)
+    assert dataset.locate(4) == (1, 0) and dataset.locate(-1) == (2, 2)
+    check_sample(dataset[-1], samples[-1])
+    with pytest.raises(IndexError):
+        dataset[len(samples)]
+
+    batches = list(dataset.batches(5, shuffle=True, seed=0))
+    assert [len(batch) for batch in batches] == [5, 5, 1]
+    assert sorted(sample["name"] for batch in batches for sample in batch) == sorted(name for name, *_ in samples)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_pickled_reader_opens_its_own_shards(tmp_path, compress):
+    samples = make_samples(6)
+    export_samples(samples, tmp_path, compress=compress, samples_per_shard=4)
+    dataset = ShardedDataset(tmp_path, arrays=["vertices", "displacement"])
+    last = dataset[5]
+    copy = pickle.loads(pickle.dumps(dataset))
+    assert copy._shards == {}
+    for i in range(len(samples)):
+        assert set(copy[i]) == {"name", "vertices", "displacement"}
+        assert np.array_equal(copy[i]["vertices"], dataset[i]["vertices"])
+    assert np.array_equal(copy[5]["displacement"], last["displacement"])
@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+import numpy as np
+import trimesh
+from shapely.geometry import Polygon
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from edge_topology import edge_topology
+from check_edges_number import unique_edges
+
+
+def vertical_edges_at(topology, vertices, x, y):
+    ends = vertices[topology["edges"]]
+    return np.flatnonzero(np.all(np.isclose(ends[:, :, :2], [x, y]), axis=(1, 2)))
+
+
+def test_box_edges_are_convex():
+    box = trimesh.creation.box(extents=[2, 3, 4])
+    topology = edge_topology(box.vertices, box.faces)
+    assert np.array_equal(topology["edges"], unique_edges(box.faces))
+    assert np.all(topology["edge_faces"] >= 0)
+    angles = np.unique(np.round(topology["dihedral_angle"], 6))
+    assert np.allclose(angles, [np.pi / 2, np.pi])
+
+
+def test_concave_edge_of_extruded_l_shape():
+    shape = trimesh.creation.extrude_polygon(Polygon([(0, 0), (2, 0), (2, 1), (1, 1), (1, 2), (0, 2)]), 1)
+    topology = edge_topology(shape.vertices, shape.faces)
+    concave = vertical_edges_at(topology, shape.vertices, 1, 1)
+    convex = vertical_edges_at(topology, shape.vertices, 2, 0)
+    assert len(concave) and len(convex)
+    assert np.allclose(topology["dihedral_angle"][concave], 3 * np.pi / 2)
+    assert np.allclose(topology["dihedral_angle"][convex], np.pi / 2)
+
+
+def test_adjacency_and_lengths_match_trimesh():
+    sphere = trimesh.creation.icosphere(3)
+    topology = edge_topology(sphere.vertices, sphere.faces)
+    keys = topology["edges"][:, 0] * len(sphere.vertices) + topology["edges"][:, 1]
+    adjacency_edges = np.sort(sphere.face_adjacency_edges, axis=1)
+    index = np.searchsorted(keys, adjacency_edges[:, 0] * len(sphere.vertices) + adjacency_edges[:, 1])
+    assert np.array_equal(np.sort(topology["edge_faces"][index], axis=1), np.sort(sphere.face_adjacency, axis=1))
+    assert np.allclose(np.pi - topology["dihedral_angle"][index], sphere.face_adjacency_angles)
+    lengths = np.linalg.norm(np.diff(sphere.vertices[topology["edges"]], axis=1)[:, 0], axis=1)
+    assert np.allclose(topology["edge_length"], lengths)
@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+dolfin = pytest.importorskip("dolfin")
+pytest.importorskip("sksparse")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from InherentStrain import InherentStrainSession
+
+
+def box_arrays(size, n):
+    mesh = dolfin.BoxMesh(dolfin.Point(0, 0, 0), dolfin.Point(*size), *n)
+    return mesh.coordinates().copy(), mesh.cells().copy()
+
+
+@pytest.mark.parametrize("backend", ["lu", "cg_amg"])
+def test_one_session_solves_meshes_of_different_sizes(tmp_path, backend):
+    session = InherentStrainSession(backend=backend)
+    results = [session.solve(Path(f"box_{i}.msh"), tmp_path, *box_arrays(size, n), write_files=False)
+               for i, (size, n) in enumerate([((1, 1, 1), (2, 2, 2)), ((2, 1, 1), (4, 2, 3)), ((1, 1, 1), (2, 2, 2))])]
+    dofs = [result["dof"] for result in results]
+    assert dofs[0] != dofs[1] and dofs[0] == dofs[2]
+    assert max(max(result["residual"]) for result in results) < 1.0e-6
@@ -3,11 +3,12 @@ import pyvista as pv
 import numpy as np
 from pathlib import Path
 from tqdm import tqdm
-from check_edges_number import remove_not_exact
+from dataset_export import orient_faces, write_stl
 
 def extraction_correction(path: Path):
     """
-    The previous extraction from the vtk files is wrong, this script have to been launched at the end of the dataset generation to correct the data.
+    The previous extraction from the vtk files is wrong, this script corrects the datasets exported before the faces were
+    oriented during the export (see dataset_export.export_samples), the new datasets do not need it.
 
     Arg:
         path: pathlib.Path where are the vtk files stored
@@ -24,11 +25,11 @@ def extraction_correction(path: Path):
         if vtk_file.stem in banned_name:
             continue
         vtk = pv.read(str(vtk_file))
-        mesh = trimesh.base.Trimesh(vertices = vtk.points , faces = vtk.faces.reshape(-1, 4)[:,1:], process=False) 
-        trimesh.repair.fix_normals(mesh)
+        faces = orient_faces(vtk.points, vtk.faces.reshape(-1, 4)[:,1:])
+        mesh = trimesh.base.Trimesh(vertices = vtk.points , faces = faces, process=False)
 
         mesh.export( vtk_file.with_suffix(".obj"))
-        mesh.export( vtk_file.with_suffix(".stl"))
+        write_stl(vtk_file.with_suffix(".stl"), vtk.points, faces)
         #trimesh.repair.fix_normals(mesh)
         #radii = np.linalg.norm( vtk.get_array("displacement"), axis=1) 
         #mesh.visual.vertex_colors = trimesh.visual.interpolate(radii, color_map='viridis')
@@ -37,5 +38,4 @@ def extraction_correction(path: Path):
 if __name__ == "__main__":
     for phase in ["validation" , "train", "test"]:
         target =  Path("cubes") / phase
-        extraction_correction(target)
-        remove_not_exact(folder_path= target, edges_target=3000 )
\ No newline at end of file
+        extraction_correction(target)
\ No newline at end of file